@@ -0,0 +1,105 @@
+# External
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Internal
+from STTBot.utils import env
+
+
+class CommandRejected(Exception):
+    pass
+
+
+class CommandExecutor:
+    """Runs commands on a bounded pool of worker threads, so the event request that triggered them is acked at once.
+
+    A command is rejected rather than queued when `queue_size` commands are already waiting for a worker, or when as
+    many commands with the same key as its entry in `limits` are already waiting or running.
+    """
+
+    def __init__(self, workers=4, queue_size=20, limits=None):
+        self.workers = max(1, int(workers))
+        self.queue_size = queue_size
+        self.limits = limits or {}
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="command")
+        self._lock = threading.Lock()
+        self._in_flight = defaultdict(int)
+        self._queued = 0
+        self._running = 0
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "wait_time": 0.0,
+                       "max_wait_time": 0.0}
+
+    def submit(self, key, func, *args):
+        """Queues a command to run on the worker pool.
+        Args:
+            key (str): The command's name, e.g. `msg match`, used for its concurrency limit.
+            func: The function to run.
+            args: Arguments passed to the function.
+        Returns:
+            Future: The result of the function.
+        Raises:
+            CommandRejected: If the queue is full or the command is at its concurrency limit.
+        """
+
+        with self._lock:
+            limit = self.limits.get(key)
+            if self._queued >= self.queue_size:
+                reason = f"I'm busy with {self._queued + self._running} other commands, try again in a moment"
+            elif limit is not None and self._in_flight[key] >= limit:
+                reason = f"Too many `{key}` commands are already running, try again in a moment"
+            else:
+                reason = None
+
+            if reason is not None:
+                self._stats["rejected"] += 1
+            else:
+                self._stats["submitted"] += 1
+                self._in_flight[key] += 1
+                self._queued += 1
+
+        if reason is not None:
+            env.log.warning(f"Rejected `{key}`: {reason}")
+            raise CommandRejected(reason)
+        return self._pool.submit(self._run, key, time.perf_counter(), func, *args)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queued"] = self._queued
+            stats["running"] = self._running
+            stats["in_flight"] = dict(self._in_flight)
+        stats["workers"] = self.workers
+        stats["avg_wait_time"] = stats["wait_time"] / stats["submitted"] if stats["submitted"] else 0.0
+        return stats
+
+    def _run(self, key, queued_at, func, *args):
+        waited = time.perf_counter() - queued_at
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._stats["wait_time"] += waited
+            self._stats["max_wait_time"] = max(self._stats["max_wait_time"], waited)
+
+        failed = False
+        try:
+            return func(*args)
+        except Exception:
+            failed = True
+            env.log.error(f"Command `{key}` failed:\n{traceback.format_exc()}")
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._in_flight[key] -= 1
+                if self._in_flight[key] == 0:
+                    del self._in_flight[key]
+                self._stats["failed" if failed else "completed"] += 1
+
+
+executor = CommandExecutor(workers=env.get_cfg("COMMAND_WORKERS") or 4,
+                           queue_size=env.get_cfg("COMMAND_QUEUE_SIZE") or 20, limits=env.get_cfg("COMMAND_LIMITS"))
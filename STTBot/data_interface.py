@@ -1,100 +1,1014 @@
 # External
 import re
 import sqlite3
+import heapq
+import itertools
 import json
-from collections import defaultdict
+import os
+import queue
+import random
+import select
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    from re import _compiler as sre_compile, _parser as sre_parse
+except ImportError:
+    import sre_compile
+    import sre_parse
+
+try:
+    from re._casefix import _EXTRA_CASES as extra_cases
+except ImportError:
+    from sre_compile import _ignorecase_fixes as extra_cases
+
+from _sre import unicode_tolower
 
 # Internal
+from STTBot.models.pin import Pin
 from STTBot.utils import env
 
 
 db = env.get_cfg("PATH_DB")
 
 
+# - Connection pool - #
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """A bounded pool of long-lived SQLite connections.
+
+    Connections are opened lazily up to `size`, configured once with the given PRAGMAs and UDFs, and handed back
+    to the pool after each use. Callers that find the pool exhausted wait up to `timeout` seconds.
+    """
+
+    def __init__(self, path, size=4, timeout=10, pragmas=None):
+        self.path = path
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "waited": 0, "timeouts": 0, "wait_time": 0.0, "max_wait_time": 0.0}
+
+    def acquire(self):
+        start = time.perf_counter()
+        try:
+            return self._record_acquire(self._idle.get_nowait(), start)
+        except queue.Empty:
+            pass
+
+        con = None
+        with self._lock:
+            if len(self._connections) < self.size:
+                con = self._connect()
+                self._connections.append(con)
+        if con is not None:
+            return self._record_acquire(con, start)
+
+        try:
+            con = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"No database connection became available within {self.timeout}s")
+
+        with self._lock:
+            self._stats["waited"] += 1
+        return self._record_acquire(con, start)
+
+    def release(self, con):
+        with self._lock:
+            if con not in self._connections:
+                con.close()
+                return
+        self._idle.put(con)
+
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for con in connections:
+            try:
+                # Lets SQLite analyze any tables the connection's queries found to be missing statistics.
+                con.execute(Query.OPTIMIZE)
+            except sqlite3.Error as e:
+                env.log.debug(f"Could not optimize database connection on close: {e}")
+            con.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self.size
+            stats["open"] = len(self._connections)
+        stats["idle"] = self._idle.qsize()
+        stats["in_use"] = stats["open"] - stats["idle"]
+        stats["avg_wait_time"] = stats["wait_time"] / stats["acquired"] if stats["acquired"] else 0.0
+        return stats
+
+    def _connect(self):
+        con = connect(self.path, self.pragmas)
+        env.log.debug(f"Opened database connection {len(self._connections) + 1}/{self.size} to {self.path}")
+        return con
+
+    def _record_acquire(self, con, start):
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._stats["acquired"] += 1
+            self._stats["wait_time"] += waited
+            self._stats["max_wait_time"] = max(self._stats["max_wait_time"], waited)
+        return con
+
+
+def connect(path, pragmas=None):
+    con = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    for key, value in (pragmas or {}).items():
+        con.execute(f"PRAGMA {key} = {value}").fetchall()
+    register_functions(con)
+    return con
+
+
+pool = ConnectionPool(db, size=env.get_cfg("DB_POOL_SIZE") or 4, timeout=env.get_cfg("DB_POOL_TIMEOUT") or 10,
+                      pragmas=env.get_cfg("DB_PRAGMAS"))
+
+
+# - Write queue - #
+
+class WriteJob:
+    def __init__(self, steps):
+        self.steps = [(statement, list(params)) for statement, params in steps]
+        self.rows = sum(len(params) for _, params in self.steps)
+        self.future = Future()
+
+
+class DatabaseWriter:
+    """A single thread that owns the database's only writing connection.
+
+    Writes are submitted as jobs of (statement, params) steps and queued. The writer drains whatever has queued up, to
+    at most `max_batch_rows` rows, and applies it in one transaction with a savepoint per job, so a failing job is
+    rolled back on its own and the rest still commit. Each job's future resolves to its row count once committed.
+    """
+
+    def __init__(self, path, pragmas=None, max_batch_rows=10000):
+        self.path = path
+        self.pragmas = pragmas or {}
+        self.max_batch_rows = max(1, int(max_batch_rows))
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"jobs": 0, "failed_jobs": 0, "rows": 0, "transactions": 0, "busy_time": 0.0,
+                       "max_queue_depth": 0}
+
+    def submit(self, steps):
+        """Queues a write job.
+        Args:
+            steps: (statement, params) pairs, each run with `executemany`.
+        Returns:
+            Future: Resolves to the number of rows written, or raises the job's error.
+        """
+
+        job = WriteJob(steps)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+            self._queue.put(job)
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        return job.future
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["rows_per_sec"] = stats["rows"] / stats["busy_time"] if stats["busy_time"] else 0.0
+        return stats
+
+    def _run(self):
+        con = connect(self.path, self.pragmas)
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    break
+                self._write(con, batch)
+        finally:
+            con.close()
+
+    def _next_batch(self):
+        job = self._queue.get()
+        if job is None:
+            return None
+
+        batch, rows = [job], job.rows
+        while rows < self.max_batch_rows:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                # Finish this batch, then stop on the next call.
+                self._queue.put(None)
+                break
+            batch.append(job)
+            rows += job.rows
+        return batch
+
+    def _write(self, con, batch):
+        start = time.perf_counter()
+        done, failed = [], []
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                con.execute("SAVEPOINT job")
+                try:
+                    for statement, params in job.steps:
+                        con.executemany(statement, params)
+                except sqlite3.Error as e:
+                    con.execute("ROLLBACK TO job")
+                    failed.append((job, e))
+                else:
+                    done.append(job)
+                con.execute("RELEASE job")
+            con.execute("COMMIT")
+        except sqlite3.Error as e:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            failed = [(job, e) for job in batch]
+            done = []
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._stats["jobs"] += len(batch)
+            self._stats["failed_jobs"] += len(failed)
+            self._stats["rows"] += sum(job.rows for job in done)
+            self._stats["transactions"] += 1
+            self._stats["busy_time"] += elapsed
+
+        for job, e in failed:
+            env.log.error(f"Write job of {job.rows} rows failed: {e!r}")
+            job.future.set_exception(e)
+        for job in done:
+            job.future.set_result(job.rows)
+
+
+writer = DatabaseWriter(db, pragmas=env.get_cfg("DB_PRAGMAS"),
+                        max_batch_rows=env.get_cfg("DB_WRITE_BATCH_ROWS") or 10000)
+
+
 # - Generic methods - #
 
-def get_cur(ignore_case=True):
-    con = sqlite3.connect(db, isolation_level=None)
-    if ignore_case:
-        con.create_function("REGEXP", 2, regexp_ignore_case)
+@contextmanager
+def get_con():
+    con = pool.acquire()
+    try:
+        yield con
+    finally:
+        pool.release(con)
+
+
+@contextmanager
+def transaction(con):
+    con.execute("BEGIN")
+    try:
+        yield con
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
     else:
-        con.create_function("REGEXP", 2, regexp)
-    return con.cursor()
+        con.execute("COMMIT")
+
+
+def get_pool_stats():
+    return pool.stats()
 
 
-def regexp_ignore_case(expr, item):
-    reg = re.compile(expr, re.IGNORECASE)
-    return reg.search(item) is not None
+def get_writer_stats():
+    return writer.stats()
+
+
+def close_connections():
+    regex_workers.close()
+    writer.stop()
+    pool.close_all()
+    data_version.close()
+
+
+def register_functions(con):
+    for name, num_params, func in [("REGEXP", 2, regexp), ("message_tokens", 1, message_tokens)]:
+        try:
+            con.create_function(name, num_params, func, deterministic=True)
+        except (TypeError, sqlite3.NotSupportedError):
+            # Python < 3.8 or SQLite < 3.8.3 can't flag functions as deterministic.
+            con.create_function(name, num_params, func)
+
+
+def regex_for(search, ignore_case=True):
+    return f"(?i){search}" if ignore_case else search
+
+
+compile_regex = lru_cache(maxsize=env.get_cfg("REGEX_CACHE_SIZE") or 128)(re.compile)
+
+
+def get_regex_cache_stats():
+    info = compile_regex.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
 
 
 def regexp(expr, item):
-    reg = re.compile(expr)
-    return reg.search(item) is not None
+    if item is None:
+        return False
+    budget = query_state.budget
+    if budget is not None:
+        budget.rows_checked += 1
+    return compile_regex(expr).search(item) is not None
+
+
+# - Query budgets - #
+
+query_time_budget = env.get_cfg("QUERY_TIME_BUDGET") or 10
+
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, message, partial=None):
+        super().__init__(message)
+        self.partial = partial
+
+
+class QueryBudget:
+    """Time and row limits for a single user-supplied query.
+
+    `check` is installed as the connection's progress handler, so SQLite aborts the running statement once either
+    limit is exceeded. Rows are counted by the REGEXP function. A single regex evaluation can't be interrupted, so the
+    budget takes effect on the next row after it runs out; `RegexWorkers` bounds the evaluation itself.
+    """
+
+    progress_interval = 10000
+
+    def __init__(self, pattern, seconds=None, rows=None):
+        self.pattern = pattern
+        self.seconds = seconds if seconds is not None else query_time_budget
+        self.rows = rows if rows is not None else env.get_cfg("QUERY_ROW_BUDGET")
+        self.start = time.perf_counter()
+        self.rows_checked = 0
+        self.reason = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def check(self):
+        if self.seconds and self.elapsed() > self.seconds:
+            self.reason = f"took longer than {self.seconds}s"
+        elif self.rows and self.rows_checked > self.rows:
+            self.reason = f"checked more than {self.rows} messages"
+        return self.reason is not None
+
+
+class _QueryState(threading.local):
+    budget = None
+
+
+query_state = _QueryState()
+
+
+@contextmanager
+def query_budget(con, pattern, seconds=None, rows=None):
+    budget = QueryBudget(pattern, seconds=seconds, rows=rows)
+    query_state.budget = budget
+    con.set_progress_handler(budget.check, QueryBudget.progress_interval)
+    try:
+        yield budget
+    except sqlite3.OperationalError as e:
+        if budget.reason is None:
+            raise
+        env.log.warning(f"Cancelled query for `{pattern}` after {budget.elapsed():.2f}s and "
+                        f"{budget.rows_checked} messages: {budget.reason}")
+        raise QueryBudgetExceeded(f"Search {budget.reason}") from e
+    finally:
+        con.set_progress_handler(None, 0)
+        query_state.budget = None
+
+
+# - Guarded regex searches - #
+
+class RegexWorkers:
+    """Runs searches with user-supplied regexes in separate worker processes, killing any that overrun.
+
+    A single `re.search` can't be interrupted from inside the process running it, so a pattern that backtracks badly
+    on one message would otherwise hold a command worker and a connection for as long as it takes. Each search gets
+    `timeout` seconds plus `grace` for its worker to give up by itself through its own query budget. Workers are started
+    on first use and reused, at most `size` of them at a time.
+    """
+
+    def __init__(self, size=2, timeout=10, grace=2):
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.grace = grace
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._stats = {"searches": 0, "started": 0, "killed": 0}
+        # The REGEXP functions' compile caches live in the workers, which report theirs with each response.
+        self._regex_caches = {}
+        self._retired_regex_cache = {"hits": 0, "misses": 0}
+
+    def run(self, search, *args):
+        """Runs one of the `guarded_searches` in a worker process.
+        Args:
+            search (str): The name of the search in `guarded_searches`.
+            args: Its JSON-serialisable arguments.
+        Returns:
+            The search's result, as decoded from JSON.
+        Raises:
+            QueryBudgetExceeded: If the search ran out of budget, or its worker was killed for overrunning.
+        """
+
+        with self._slots:
+            worker = self._checkout()
+            try:
+                response = self._request(worker, search, args)
+            except BaseException:
+                self._kill(worker)
+                raise
+            self._idle.put(worker)
+
+        if "budget" in response:
+            raise QueryBudgetExceeded(response["budget"], partial=response.get("partial"))
+        if "error" in response:
+            raise RuntimeError(f"Search worker failed: {response['error']}")
+        return response["result"]
+
+    def close(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.stdin.close()
+            worker.wait()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            caches = list(self._regex_caches.values())
+            regex_cache = dict(self._retired_regex_cache)
+        stats["idle"] = self._idle.qsize()
+        for key in ["hits", "misses", "size"]:
+            regex_cache[key] = regex_cache.get(key, 0) + sum(cache[key] for cache in caches)
+        regex_cache["max_size"] = compile_regex.cache_info().maxsize
+        stats["regex_cache"] = regex_cache
+        return stats
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        # The worker reads the same command line, so it loads the same config.
+        path = os.environ.get("PYTHONPATH")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        worker = subprocess.Popen([sys.executable, "-m", "STTBot.regex_worker"] + sys.argv[1:],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1,
+                                  env={**os.environ, "PYTHONPATH": root + (os.pathsep + path if path else "")})
+        with self._lock:
+            self._stats["started"] += 1
+        return worker
+
+    def _request(self, worker, search, args):
+        with self._lock:
+            self._stats["searches"] += 1
+        worker.stdin.write(json.dumps({"search": search, "args": args}) + "\n")
+        ready, _, _ = select.select([worker.stdout], [], [], self.timeout + self.grace)
+        if len(ready) == 0:
+            with self._lock:
+                self._stats["killed"] += 1
+            env.log.warning(f"Killed search worker running {search}{tuple(args)} after {self.timeout + self.grace}s")
+            raise QueryBudgetExceeded(f"Search took longer than {self.timeout}s")
+
+        line = worker.stdout.readline()
+        if len(line) == 0:
+            raise RuntimeError(f"Search worker exited with code {worker.wait()}")
+        response = json.loads(line)
+        with self._lock:
+            self._regex_caches[worker.pid] = response.pop("regex_cache")
+        return response
+
+    def _kill(self, worker):
+        worker.kill()
+        worker.wait()
+        with self._lock:
+            cache = self._regex_caches.pop(worker.pid, None)
+            if cache is not None:
+                self._retired_regex_cache["hits"] += cache["hits"]
+                self._retired_regex_cache["misses"] += cache["misses"]
+
+
+regex_workers = RegexWorkers(size=env.get_cfg("REGEX_WORKERS") or 2, timeout=query_time_budget)
+
+
+def get_regex_worker_stats():
+    return regex_workers.stats()
+
+
+def check_regex(expr):
+    """Compiles a user-supplied regex and rejects it if it's ambiguous in a way that backtracks exponentially.
+
+    Catches repeated groups whose iterations can split the same text in more than one way, e.g. `(a+)+` and
+    `(\\w+\\s?)*`, and repeated alternatives that can match the same character, e.g. `(.|\\s)*`. Everything else,
+    including backreferences and slower but polynomial patterns like `.*.*x`, is left to `RegexWorkers`.
+    Raises:
+        re.error: If the regex is invalid.
+        QueryBudgetExceeded: If the regex could backtrack exponentially.
+    """
+
+    compile_regex(expr)
+    try:
+        parsed = sre_parse.parse(expr)
+        state = getattr(parsed, "state", None) or parsed.pattern
+        problem = _backtracking_problem(parsed, False, state.flags)
+    except (RecursionError, OverflowError):
+        raise QueryBudgetExceeded("Search pattern is too complex")
+    if problem is not None:
+        raise QueryBudgetExceeded(f"Search pattern {problem}")
+
+
+def _backtracking_problem(subpattern, repeated, flags):
+    for op, av in subpattern:
+        if op in _repeat_ops:
+            repeats = av[0] != av[1] and av[1] > 1 and op in _backtracking_repeat_ops
+            if repeats and _iterations_overlap(av[2], flags):
+                return "repeats a group whose iterations can match the same text"
+            problem = _backtracking_problem(av[2], repeated or repeats, flags)
+        elif op is sre_parse.BRANCH:
+            if repeated and _alternatives_overlap(av[1], flags):
+                return "repeats alternatives that can match the same text"
+            problem = next(filter(None, (_backtracking_problem(branch, repeated, flags) for branch in av[1])), None)
+        elif op is sre_parse.SUBPATTERN:
+            problem = _backtracking_problem(av[3], repeated, _scoped_flags(flags, av))
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            problem = _backtracking_problem(av[1], repeated, flags)
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            problem = _backtracking_problem(av, repeated, flags)
+        else:
+            problem = None
+        if problem is not None:
+            return problem
+    return None
+
+
+def _iterations_overlap(body, flags):
+    """Returns whether a repeat at one end of a repeated body could also match the other end of the next iteration,
+    e.g. the inner `a+` of `(a+)+`, so that a run of text can be split between iterations in many ways.
+    """
+    for from_end in (True, False):
+        edge = _edge_chars(body, flags, not from_end)[0]
+        for repeat_body, repeat_flags in _edge_repeats(body, flags, from_end):
+            if _chars_overlap(edge, _edge_chars(repeat_body, repeat_flags, not from_end)[0]):
+                return True
+    return False
+
+
+def _alternatives_overlap(branches, flags):
+    singles = [_edge_chars(branch, flags, False)[0] for branch in branches if branch.getwidth() == (1, 1)]
+    return any(_chars_overlap(first, second) for first, second in itertools.combinations(singles, 2))
+
+
+def _edge_chars(subpattern, flags, from_end):
+    """Returns the single-character items, with their flags, that a subpattern's matches can start with (or end with,
+    if `from_end`), and whether it can match empty text. Items `check_regex` doesn't follow, like backreferences, end
+    the search.
+    """
+    chars = []
+    for op, av in (reversed(subpattern.data) if from_end else subpattern.data):
+        item_chars, nullable = _item_edge_chars(op, av, flags, from_end)
+        chars += item_chars
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+def _item_edge_chars(op, av, flags, from_end):
+    if op in _char_ops:
+        return [((op, av), flags)], False
+    if op is sre_parse.SUBPATTERN:
+        return _edge_chars(av[3], _scoped_flags(flags, av), from_end)
+    if op in _repeat_ops:
+        chars, nullable = _edge_chars(av[2], flags, from_end)
+        return chars, nullable or av[0] == 0
+    if op is sre_parse.BRANCH:
+        edges = [_edge_chars(branch, flags, from_end) for branch in av[1]]
+        return [char for chars, _ in edges for char in chars], any(nullable for _, nullable in edges)
+    if op is getattr(sre_parse, "ATOMIC_GROUP", None):
+        return _edge_chars(av, flags, from_end)
+    if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return [], True
+    return [], False
+
+
+def _edge_repeats(subpattern, flags, from_end):
+    """Yields the bodies, with their flags, of the backtracking repeats a subpattern's matches can start with (or end
+    with, if `from_end`)."""
+    for op, av in (reversed(subpattern.data) if from_end else subpattern.data):
+        if op in _backtracking_repeat_ops and av[0] != av[1] and av[1] > 1:
+            yield av[2], flags
+        elif op is sre_parse.SUBPATTERN:
+            yield from _edge_repeats(av[3], _scoped_flags(flags, av), from_end)
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                yield from _edge_repeats(branch, flags, from_end)
+        if not _item_edge_chars(op, av, flags, from_end)[1]:
+            return
+
+
+def _chars_overlap(first, second):
+    """Returns whether any character matches one of the items in `first` and one of the items in `second`."""
+    if len(first) == 0 or len(second) == 0:
+        return False
+
+    candidates = set(overlap_candidates)
+    for (op, av), _ in first + second:
+        for item_op, item_av in (av if op is sre_parse.IN else [(op, av)]):
+            if item_op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL):
+                candidates.add(chr(item_av))
+            elif item_op is sre_parse.RANGE:
+                candidates.update(map(chr, item_av))
+    candidates |= {case for char in candidates for case in (char.lower(), char.upper())}
+
+    first_matchers = [_char_matcher(item, flags) for item, flags in first]
+    second_matchers = [_char_matcher(item, flags) for item, flags in second]
+    return any(any(matcher.fullmatch(char) for matcher in first_matchers) and
+               any(matcher.fullmatch(char) for matcher in second_matchers) for char in candidates)
+
+
+def _char_matcher(item, flags):
+    state = sre_parse_state()
+    state.flags = flags
+    return sre_compile.compile(sre_parse.SubPattern(state, [item]))
+
+
+def _scoped_flags(flags, subpattern_av):
+    return (flags | subpattern_av[1]) & ~subpattern_av[2]
+
+
+# Characters tried when checking whether two character classes overlap, on top of those the classes name.
+overlap_candidates = [chr(code) for code in range(0x250)]
+sre_parse_state = getattr(sre_parse, "State", None) or sre_parse.Pattern
+_char_ops = {sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.ANY}
+_backtracking_repeat_ops = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+
+
+# - Result cache - #
+
+class ResultCache:
+    """An LRU cache of query results, bounded by their estimated size in memory.
+
+    Each table has a data version that's bumped once a write to it commits. Results are stored with the version of
+    the table they were read from at the time the query started, and a result from an older version is a miss, so a
+    result never outlives the data it was computed from. Writes this process doesn't make itself, e.g. from
+    `load_messages.py` running next to the bot, are caught by checking `data_version` on every lookup, and bump every
+    table since there's no telling which one they touched.
+    """
+
+    def __init__(self, max_bytes=16 * 2**20, data_version=None):
+        self.max_bytes = max_bytes
+        self.data_version = data_version
+        self._last_data_version = None
+        self._entries = OrderedDict()
+        self._versions = defaultdict(int)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "data_version_changes": 0}
+
+    def get_or_compute(self, key, table, compute):
+        """Returns the cached result for a key, or computes and caches it.
+        Args:
+            key (tuple): The query kind followed by everything its result depends on.
+            table (str): The table the result is read from.
+            compute: A function returning the result. Exceptions aren't cached.
+        """
+
+        with self._lock:
+            self._check_data_version()
+            version = self._versions[table]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[1]
+            if entry is not None:
+                self._stats["stale"] += 1
+                self._remove(key)
+            self._stats["misses"] += 1
+
+        value = compute()
+        size = _estimate_size(key) + _estimate_size(value)
+        with self._lock:
+            self._check_data_version()
+            if size <= self.max_bytes and version == self._versions[table]:
+                if key in self._entries:
+                    self._remove(key)
+                self._entries[key] = (version, value, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self._stats["evictions"] += 1
+        return value
+
+    def bump(self, table):
+        with self._lock:
+            self._versions[table] += 1
+
+    def bump_on_commit(self, future, table):
+        future.add_done_callback(lambda _: self.bump(table))
+        return future
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["versions"] = dict(self._versions)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _check_data_version(self):
+        if self.data_version is None:
+            return
+        current = self.data_version()
+        if self._last_data_version is not None and current != self._last_data_version:
+            for table in self._versions:
+                self._versions[table] += 1
+            self._stats["data_version_changes"] += 1
+        self._last_data_version = current
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+
+class DataVersion:
+    """Reads SQLite's `PRAGMA data_version` on a connection of its own, which never writes.
+
+    The value changes whenever any other connection commits a write to the database, whether it's in this process or
+    another one. Not thread-safe, `ResultCache` calls it while holding its lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._con = None
+
+    def __call__(self):
+        if self._con is None:
+            self._con = connect(self.path)
+        return self._con.execute(Query.GET_DATA_VERSION).fetchone()[0]
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+
+def _estimate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_estimate_size(key) + _estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_estimate_size(item) for item in value)
+    return size
+
+
+data_version = DataVersion(db)
+result_cache = ResultCache(max_bytes=env.get_cfg("RESULT_CACHE_BYTES") or 16 * 2**20, data_version=data_version)
+
+
+def get_result_cache_stats():
+    return result_cache.stats()
 
 
 # - Pin queries - #
 
 def get_pin(channel, timestamp):
-    cur = get_cur()
-    cur.execute(Query.GET_PIN, (channel, timestamp))
-    row = cur.fetchone()
-    cur.close()
+    with get_con() as con:
+        row = con.execute(Query.GET_PIN, (channel, timestamp)).fetchone()
 
     if row is None:
         return None
     else:
-        return row[0], row[1], json.loads(row[2]), row[3]
+        return Pin.from_row(row)
 
 
 def get_random_pin(channel=None):
-    cur = get_cur()
-    if channel is not None:
-        cur.execute(Query.GET_RANDOM_PIN_FROM_CHANNEL, [channel])
-    else:
-        cur.execute(Query.GET_RANDOM_PIN)
-    row = cur.fetchone()
-    cur.close()
+    while True:
+        rowid = pin_decks.draw(channel)
+        if rowid is None:
+            return None
 
-    if row is None:
-        return None
-    else:
-        return row[0], row[1], json.loads(row[2]), row[3]
+        with get_con() as con:
+            row = con.execute(Query.GET_PIN_BY_ROWID, [rowid]).fetchone()
+
+        # The pin may have been removed since the deck was dealt.
+        if row is not None:
+            return Pin.from_row(row)
 
 
 def get_all_pins(channel=None):
-    cur = get_cur()
-    if channel is not None:
-        cur.execute(Query.GET_ALL_PINS_FROM_CHANNEL, [channel])
-    else:
-        cur.execute(Query.GET_ALL_PINS)
-    rows = cur.fetchall()
-    cur.close()
+    with get_con() as con:
+        if channel is not None:
+            rows = con.execute(Query.GET_ALL_PINS_FROM_CHANNEL, [channel]).fetchall()
+        else:
+            rows = con.execute(Query.GET_ALL_PINS).fetchall()
 
     if len(rows) == 0:
         return None
     else:
-        return [[row[0], row[1], json.loads(row[2]), row[3]] for row in rows]
+        return [Pin.from_row(row) for row in rows]
 
 
 def insert_pin(user, channel, timestamp, message_json, permalink):
-    cur = get_cur()
-    cur.execute(Query.INSERT_PIN, (user, channel, timestamp, message_json, permalink))
-    cur.close()
+    columns = Pin.extract_columns(json.loads(message_json))
+    params = {"created_by": user, "channel": channel, "timestamp": timestamp, "json": message_json,
+              "permalink": permalink, **columns}
+    future = writer.submit([(Query.INSERT_PIN, [params])])
+    future.add_done_callback(lambda _: pin_decks.invalidate(channel))
+    return result_cache.bump_on_commit(future, Table.PINS)
+
+
+def insert_pins(user, pins):
+    """Inserts every pin that isn't stored yet as a single write job.
+
+    Existing pins are found with one query over all the pins' channels, so loading a channel's pins costs one read and
+    one transaction however many there are.
+    Args:
+        user (str): The id of the user adding the pins.
+        pins: (channel, timestamp, message_json, permalink) tuples.
+    Returns:
+        tuple: The number of pins added and the number already stored.
+    """
+
+    channels = sorted({channel.lower() for channel, _, _, _ in pins})
+    if len(channels) == 0:
+        return 0, 0
+
+    existing = get_pin_keys(channels)
+    new_pins = {}
+    for channel, timestamp, message_json, permalink in pins:
+        key = (channel.lower(), timestamp)
+        if key not in existing and key not in new_pins:
+            new_pins[key] = {"created_by": user, "channel": channel, "timestamp": timestamp, "json": message_json,
+                             "permalink": permalink, **Pin.extract_columns(json.loads(message_json))}
+
+    if len(new_pins) > 0:
+        result_cache.bump_on_commit(writer.submit([(Query.INSERT_PIN, list(new_pins.values()))]), Table.PINS).result()
+        for channel in channels:
+            pin_decks.invalidate(channel)
+    return len(new_pins), len(pins) - len(new_pins)
+
+
+def get_pin_keys(channels):
+    """Returns the (channel, timestamp) keys of every pin in the given channels, with channels lowercased."""
+    channels = sorted({channel.lower() for channel in channels})
+    with get_con() as con:
+        rows = con.execute(Query.GET_PIN_KEYS_FROM_CHANNELS.format(channels=", ".join("?" * len(channels))),
+                           channels).fetchall()
+
+    return {(row[0].lower(), row[1]) for row in rows}
 
 
 def remove_pin(channel, timestamp):
-    cur = get_cur()
-    cur.execute(Query.REMOVE_PIN, (channel, timestamp))
-    cur.close()
+    future = writer.submit([(Query.REMOVE_PIN, [(channel, timestamp)])])
+    future.add_done_callback(lambda _: pin_decks.invalidate(channel))
+    return result_cache.bump_on_commit(future, Table.PINS)
+
+
+def get_pin_author_counts(channel=None):
+    """Returns (author_id, count) pairs from the materialized pin counts, highest count first."""
+    scope = channel.lower() if channel is not None else None
+    return result_cache.get_or_compute(("pin_author_counts", scope), Table.PINS,
+                                       lambda: _get_pin_author_counts(channel))
+
+
+def _get_pin_author_counts(channel):
+    with get_con() as con:
+        if channel is not None:
+            rows = con.execute(Query.GET_PIN_AUTHOR_COUNTS_FROM_CHANNEL, [channel]).fetchall()
+        else:
+            rows = con.execute(Query.GET_PIN_AUTHOR_COUNTS).fetchall()
+
+    if len(rows) == 0:
+        return None
+    else:
+        return [(row[0], row[1]) for row in rows]
+
+
+def check_pin_author_counts(repair=False):
+    """Compares the materialized pin counts with a full recount of the pins table.
+    Args:
+        repair (bool): Whether to rebuild the counts if they don't match.
+    Returns:
+        dict: Mismatched (channel, author_id) keys mapped to their (materialized, recounted) counts.
+    """
+    with get_con() as con:
+        materialized = {(row[0].lower(), row[1]): row[2] for row in con.execute(Query.GET_ALL_PIN_AUTHOR_COUNTS)}
+        recounted = {(row[0].lower(), row[1]): row[2] for row in con.execute(Query.RECOUNT_PIN_AUTHORS)}
+
+    mismatches = {key: (materialized.get(key, 0), recounted.get(key, 0))
+                  for key in materialized.keys() | recounted.keys()
+                  if materialized.get(key, 0) != recounted.get(key, 0)}
+    if len(mismatches) > 0 and repair:
+        rebuild_pin_author_counts()
+    return mismatches
+
+
+def rebuild_pin_author_counts():
+    with get_con() as con, transaction(con):
+        con.execute(Query.CLEAR_PIN_AUTHOR_COUNTS)
+        con.execute(Query.REBUILD_PIN_AUTHOR_COUNTS)
+    result_cache.bump(Table.PINS)
+    env.log.info("Rebuilt pin author counts")
+
+
+class PinDecks:
+    """Shuffled decks of message pin rowids, one per channel plus one for all channels.
+
+    Drawing pops from the deck, so every pin comes up once before any repeats. An empty deck is re-dealt from the
+    database, as is a channel's deck after its pins change.
+    """
+
+    all_channels = None
+
+    def __init__(self):
+        self._decks = {}
+        self._lock = threading.Lock()
+
+    def draw(self, channel=None):
+        key = channel.lower() if channel is not None else self.all_channels
+        with self._lock:
+            deck = self._decks.get(key)
+            if not deck:
+                deck = self._deal(channel)
+                self._decks[key] = deck
+            return deck.pop() if deck else None
+
+    def invalidate(self, channel):
+        with self._lock:
+            self._decks.pop(channel.lower(), None)
+            self._decks.pop(self.all_channels, None)
+
+    def _deal(self, channel):
+        with get_con() as con:
+            if channel is not None:
+                rows = con.execute(Query.GET_MESSAGE_PIN_ROWIDS_FROM_CHANNEL, [channel]).fetchall()
+            else:
+                rows = con.execute(Query.GET_MESSAGE_PIN_ROWIDS).fetchall()
+
+        deck = [row[0] for row in rows]
+        random.shuffle(deck)
+        return deck
+
+
+pin_decks = PinDecks()
 
 
 # - Message queries - #
 
 def get_msg_leaderboard(search, ignore_case=True):
-    cur = get_cur(ignore_case=ignore_case)
-    cur.execute(Query.MSG_LEADERBOARD, [search])
-    rows = cur.fetchall()
-    cur.close()
+    check_regex(regex_for(search, ignore_case))
+    return result_cache.get_or_compute(("msg_leaderboard", search, ignore_case), Table.MESSAGES,
+                                       lambda: regex_workers.run("msg_leaderboard", search, ignore_case))
+
+
+def _get_msg_leaderboard(search, ignore_case):
+    expr = regex_for(search, ignore_case)
+    filters, params = plan_regex_filters(expr)
+    with get_con() as con, query_budget(con, expr):
+        rows = con.execute(Query.MSG_LEADERBOARD.format(filters=filters), params + [expr]).fetchall()
 
     leaderboard = {}
     if len(rows) == 0:
@@ -106,57 +1020,777 @@ def get_msg_leaderboard(search, ignore_case=True):
     return leaderboard
 
 
-def get_msg_match(search, ignore_case=True):
-    cur = get_cur(ignore_case=ignore_case)
-    cur.execute(Query.MSG_MATCH, [search])
-    rows = cur.fetchall()
-    cur.close()
+def get_msg_match(search, ignore_case=True, limit=None):
+    limit = limit or env.get_cfg("MSG_MATCH_LIMIT") or 10
+    check_regex(regex_for(search, ignore_case))
+    return result_cache.get_or_compute(("msg_match", search, ignore_case, limit), Table.MESSAGES,
+                                       lambda: regex_workers.run("msg_match", search, ignore_case, limit))
+
 
+def _get_msg_match(search, ignore_case, limit):
+    expr = regex_for(search, ignore_case)
+    filters, params = plan_regex_filters(expr)
+    pattern = compile_regex(expr)
     leaderboard = defaultdict(int)
+    matched_rows = 0
+
+    try:
+        with get_con() as con, query_budget(con, expr):
+            for row in con.execute(Query.MSG_MATCH.format(filters=filters), params + [expr]):
+                matched_rows += 1
+                for match in pattern.findall(row[0]):
+                    leaderboard[match.lower()] += 1
+    except QueryBudgetExceeded as e:
+        if len(leaderboard) > 0:
+            e.partial = _top_matches(leaderboard, limit)
+        raise
+
+    if matched_rows == 0:
+        return None
+
+    return _top_matches(leaderboard, limit)
+
+
+def get_word_leaderboard(words):
+    """Returns the leaderboard for messages containing the given words as a whole-word phrase.
+
+    Uses the word index for short phrases, or the full-text index to find candidate messages for longer ones, and
+    falls back to a REGEXP scan of the whole table otherwise. Every path confirms candidates with the same
+    `\\b<words>\\b` case-insensitive pattern. The full-text index can still miss a match whose words sit right next to
+    a combining mark, since `unicode61` counts those as part of a word and `re` doesn't.
+    """
+    return result_cache.get_or_compute(("word_leaderboard", tuple(words)), Table.MESSAGES,
+                                       lambda: _get_word_leaderboard(words))
+
+
+def _get_word_leaderboard(words):
+    search = f"\\b{' '.join(words)}\\b"
+    plain_words = all(word_token_pattern.fullmatch(word) for word in words)
+    if word_index_enabled and plain_words and len(words) <= word_index_max_words:
+        return _get_indexed_word_leaderboard(words)
+    fts_query = _fts_phrase_query(words) if fts_enabled and plain_words else None
+    if fts_query is None:
+        return get_msg_leaderboard(search, ignore_case=True)
+
+    expr = regex_for(search, True)
+    with get_con() as con, query_budget(con, expr):
+        rows = con.execute(Query.MSG_LEADERBOARD_FTS, [fts_query, expr]).fetchall()
+
     if len(rows) == 0:
         return None
-    else:
+    return {row[0]: int(row[1]) for row in rows}
+
+
+def _top_matches(leaderboard, limit):
+    return dict(heapq.nlargest(limit, leaderboard.items(), key=lambda x: x[1]))
+
+
+# The searches `RegexWorkers` runs in its worker processes.
+guarded_searches = {"msg_leaderboard": _get_msg_leaderboard, "msg_match": _get_msg_match}
+
+
+def get_messages(keys):
+    """Looks up archived messages by key.
+    Args:
+        keys: (channel_id, timestamp) pairs.
+    Returns:
+        dict: Each key found mapped to its message's row.
+    """
+
+    keys = list(set(keys))
+    messages = {}
+    with get_con() as con:
+        for start in range(0, len(keys), max_keys_per_query):
+            batch = keys[start:start + max_keys_per_query]
+            query = Query.GET_MESSAGES_BY_KEYS.format(keys=", ".join(["(?, ?)"] * len(batch)))
+            for row in con.execute(query, [value for key in batch for value in key]):
+                messages[(row[1], row[0])] = {"timestamp": row[0], "channel_id": row[1], "channel_name": row[2],
+                                              "user_id": row[3], "user_name": row[4], "message": row[5],
+                                              "permalink": row[6]}
+
+    return messages
+
+
+# SQLite versions before 3.32 allow at most 999 parameters per statement.
+max_keys_per_query = 400
+
+
+def insert_messages(message_data):
+    return result_cache.bump_on_commit(writer.submit([(Query.INSERT_MESSAGE, message_data)]), Table.MESSAGES)
+
+
+def apply_message_changes(changes):
+    """Applies (MessageChange, params) pairs in order as a single write job."""
+    future = writer.submit([(kind, [params for _, params in group])
+                            for kind, group in itertools.groupby(changes, key=lambda change: change[0])])
+    return result_cache.bump_on_commit(future, Table.MESSAGES)
+
+
+def get_backfill_state():
+    with get_con() as con:
+        rows = con.execute(Query.GET_BACKFILL_STATE).fetchall()
+
+    return {row[0]: {"range_start": row[1], "range_end": row[2], "position": row[3], "cursor": row[4]} for row in rows}
+
+
+def get_backfill_updated_at():
+    with get_con() as con:
+        return con.execute(Query.GET_BACKFILL_UPDATED_AT).fetchone()[0]
+
+
+def set_backfill_state(channel_id, range_start, range_end, position, cursor):
+    return writer.submit([(Query.SET_BACKFILL_STATE,
+                           [(channel_id, range_start, range_end, position, cursor, time.time())])])
+
+
+def get_seen_events(since):
+    with get_con() as con:
+        rows = con.execute(Query.GET_SEEN_EVENTS, [since]).fetchall()
+
+    return [(row[0], row[1]) for row in rows]
+
+
+def add_seen_event(event_id, seen_at):
+    return writer.submit([(Query.INSERT_SEEN_EVENT, [(event_id, seen_at)])])
+
+
+def prune_seen_events(before):
+    return writer.submit([(Query.PRUNE_SEEN_EVENTS, [(before,)])])
+
+
+def get_sync_state():
+    with get_con() as con:
+        rows = con.execute(Query.GET_SYNC_STATE).fetchall()
+
+    return {row[0]: row[1] for row in rows}
+
+
+def set_sync_state(channel_id, high_water_mark):
+    return writer.submit([(Query.SET_SYNC_STATE, [(channel_id, high_water_mark, time.time())])])
+
+
+# - User queries - #
+
+def get_users():
+    with get_con() as con:
+        rows = con.execute(Query.GET_USERS).fetchall()
+
+    return [{"id": row[0], "name": row[1], "avatar": row[2], "updated_at": row[3]} for row in rows]
+
+
+def upsert_users(users):
+    return writer.submit([(Query.UPSERT_USER, users)])
+
+
+# - Query planning - #
+
+max_prefilters = 3
+# LIKE only folds ASCII case, so case-insensitive literals are split around non-ASCII characters and the ASCII letters
+# that a case-insensitive regex also matches to non-ASCII characters (e.g. 'k' and the Kelvin sign).
+like_unsafe_pattern = re.compile(r"[^\x01-\x7f]|[iIkKsS]")
+
+
+def plan_regex_filters(expr):
+    """Returns SQL conditions narrowing the rows that could possibly match the regex `expr`.
+
+    Literal substrings that every match must contain are pulled out of the parsed pattern and checked with `instr`,
+    or with `LIKE` where they are matched case-insensitively. The conditions are only a prefilter, REGEXP must still be
+    applied to the surviving rows.
+
+    Args:
+        expr (str): The regex as passed to REGEXP.
+    Returns:
+        tuple: A string of `<condition> AND ` clauses to put in front of the REGEXP check, and their parameters.
+    """
+    try:
+        parsed = sre_parse.parse(expr)
+    except (re.error, RecursionError, OverflowError):
+        return "", []
+
+    state = getattr(parsed, "state", None) or parsed.pattern
+    literals = _required_literals(parsed, bool(state.flags & re.IGNORECASE))
+
+    filters, params = [], []
+    for literal, ignore_case in sorted(set(literals), key=lambda item: len(item[0]), reverse=True)[:max_prefilters]:
         if ignore_case:
-            pattern = re.compile(search, re.IGNORECASE)
+            filters.append("message LIKE ? ESCAPE '\\' AND ")
+            params.append(f"%{_escape_like(literal)}%")
         else:
-            pattern = re.compile(search)
-        for row in rows:
-            matches = pattern.findall(row[0])
-            for match in matches:
-                leaderboard[match.lower()] += 1
+            filters.append("instr(message, ?) > 0 AND ")
+            params.append(literal)
 
-    return_dict = {}
-    num_to_display = 10
-    for k, v in sorted(leaderboard.items(), key=lambda x: x[1], reverse=True):
-        return_dict[k] = v
-        num_to_display -= 1
-        if num_to_display <= 0:
-            break
+    return "".join(filters), params
 
-    return return_dict
 
+def _required_literals(subpattern, ignore_case):
+    literals = []
+    run = []
 
-def insert_messages(message_data):
-    cur = get_cur()
-    cur.executemany(Query.INSERT_MESSAGE, message_data)
-    cur.close()
+    def end_run():
+        if ignore_case:
+            pieces = like_unsafe_pattern.split("".join(run))
+        else:
+            pieces = "".join(run).split("\x00")
+        literals.extend((piece, ignore_case) for piece in pieces if len(piece) > 0)
+        run.clear()
+
+    for op, av in subpattern:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+
+        end_run()
+        if op is sre_parse.SUBPATTERN:
+            add_flags, del_flags, pattern = av[1], av[2], av[3]
+            sub_ignore_case = (ignore_case or bool(add_flags & re.IGNORECASE)) and not del_flags & re.IGNORECASE
+            literals.extend(_required_literals(pattern, sub_ignore_case))
+        elif op in _repeat_ops and av[0] >= 1:
+            literals.extend(_required_literals(av[2], ignore_case))
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            literals.extend(_required_literals(av, ignore_case))
+
+    end_run()
+    return literals
+
+
+def _escape_like(literal):
+    return literal.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+_repeat_ops = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)} - {None}
+
+
+# - Schema - #
+
+def ensure_schema():
+    """Migrates the database to the latest schema version, then sets up the full-text and word indexes.
+
+    The version is kept in `PRAGMA user_version`. Migrations only use idempotent statements, so one interrupted
+    partway through is simply run again on the next start. Returns whether the full-text index is usable.
+    """
+    with get_con() as con:
+        version = con.execute(Query.GET_SCHEMA_VERSION).fetchone()[0]
+    if version > len(migrations):
+        env.log.warning(f"Database schema version {version} is newer than this code's {len(migrations)}")
+
+    for number, migration in enumerate(migrations[version:], start=version + 1):
+        start = time.perf_counter()
+        migration()
+        with get_con() as con:
+            con.execute(Query.SET_SCHEMA_VERSION.format(version=number))
+        env.log.info(f"Migrated database to schema version {number} ({migration.__name__.strip('_')}) in "
+                     f"{time.perf_counter() - start:.2f}s")
+
+    # Only does anything if an import was killed partway through.
+    finish_bulk_load()
+    fts_usable = ensure_fts_index()
+    ensure_word_index()
+    return fts_usable
+
+
+def _create_tables():
+    with get_con() as con:
+        counts_created = not _table_exists(con, Table.PIN_AUTHOR_COUNTS)
+        for statement in Query.CREATE_TABLES:
+            con.execute(statement)
+        added_columns = _add_missing_columns(con, Table.PINS, pin_extracted_columns)
+        _add_missing_columns(con, Table.MESSAGES, message_columns)
+        for statement in Query.CREATE_INDEXES + Query.CREATE_TRIGGERS:
+            con.execute(statement)
+    backfill_pin_columns(all_rows=len(added_columns) > 0)
+    if counts_created:
+        rebuild_pin_author_counts()
+
+
+def _add_lookup_indexes():
+    with get_con() as con:
+        for statement in Query.CREATE_LOOKUP_INDEXES:
+            con.execute(statement)
+        # Tables created with the (channel_id, timestamp) primary key already have this index.
+        if not _has_index(con, Table.MESSAGES, ["channel_id", "timestamp"]):
+            con.execute(Query.CREATE_MESSAGES_CHANNEL_INDEX)
+    analyze_database()
+
+
+def _add_bulk_load_state():
+    with get_con() as con:
+        con.execute(Query.CREATE_BULK_LOAD_STATE)
+
+
+def _refold_word_index():
+    # Word indexes built before `fold_case` hold `str.lower` tokens, which miss some case-insensitive matches.
+    with get_con() as con:
+        exists = _table_exists(con, Table.WORD_COUNTS)
+    if exists:
+        rebuild_word_index()
+
+
+def _rebuild_word_index_table():
+    # The word index used to keep a rowid, storing every row a second time in its primary key index, and its triggers
+    # read each message's tokens twice. `ensure_word_index` recreates and recounts it.
+    triggers = [f"{Table.WORD_COUNTS}_{action}" for action in ["insert", "delete", "update"]]
+    with get_con() as con, transaction(con):
+        for trigger in triggers:
+            con.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        con.executemany(Query.DELETE_BULK_LOAD_OBJECT, [[trigger] for trigger in triggers])
+        con.execute(f"DROP TABLE IF EXISTS {Table.WORD_COUNTS}")
+
+
+migrations = [_create_tables, _add_lookup_indexes, _add_bulk_load_state, _refold_word_index,
+              _rebuild_word_index_table]
+
+
+def analyze_database():
+    """Refreshes the statistics the query planner uses to choose between indexes.
+
+    Each index is sampled rather than read in full (`DB_ANALYSIS_LIMIT` rows), so this is cheap enough to schedule.
+    """
+    start = time.perf_counter()
+    with get_con() as con:
+        con.execute(Query.SET_ANALYSIS_LIMIT.format(limit=analysis_limit))
+        con.execute(Query.ANALYZE)
+    env.log.info(f"Analyzed database in {time.perf_counter() - start:.2f}s")
+
+
+analysis_limit = env.get_cfg("DB_ANALYSIS_LIMIT") or 1000
+
+
+def explain_queries():
+    """Gets SQLite's plan for every query in `Query`, to check which ones use an index.
+
+    Placeholders are filled in as for a single value with no prefilters. Statements that can't be planned, e.g.
+    because an optional index doesn't exist, report their error instead.
+    Returns:
+        dict: Each query's name mapped to the detail lines of its plan.
+    """
+
+    plans = {}
+    with get_con() as con:
+        for name, query in vars(Query).items():
+            if not isinstance(query, str) or query.split(" ", 1)[0].upper() not in explainable_statements:
+                continue
+            query = query.format(filters="", keys="(?, ?)", channels="?")
+            params = defaultdict(lambda: None) if ":" in query else [None] * query.count("?")
+            try:
+                plans[name] = [row[3] for row in con.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+            except sqlite3.Error as e:
+                plans[name] = [f"error: {e}"]
+    return plans
+
+
+explainable_statements = {"DELETE", "INSERT", "SELECT", "UPDATE"}
+
+
+def backfill_pin_columns(all_rows=False):
+    """Fills in the columns extracted from each pin's JSON for rows stored before they existed.
+    Args:
+        all_rows (bool): Whether to backfill every pin, rather than only those with no type yet.
+    """
+    with get_con() as con:
+        rows = con.execute(Query.GET_ALL_PINS_TO_BACKFILL if all_rows else Query.GET_PINS_TO_BACKFILL).fetchall()
+        if len(rows) == 0:
+            return
+        updates = [dict(Pin.extract_columns(json.loads(row[1] or "{}")), rowid=row[0]) for row in rows]
+        with transaction(con):
+            con.executemany(Query.BACKFILL_PIN, updates)
+    env.log.info(f"Backfilled columns for {len(rows)} pins")
+
+
+def _add_missing_columns(con, table, columns):
+    existing = {row[1] for row in con.execute(f"PRAGMA table_info({table})")}
+    added = []
+    for column, column_type in columns.items():
+        if column not in existing:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            env.log.info(f"Added column {column} to {table}")
+            added.append(column)
+    return added
+
+
+pin_extracted_columns = {"type": "text", "author_id": "text", "message_ts": "text", "text": "text"}
+message_columns = {"channel_name": "text", "user_id": "text", "user_name": "text", "message": "text",
+                   "permalink": "text"}
+
+
+# - Full-text index - #
+
+word_token_pattern = re.compile(r"\w+")
+fts_enabled = False
+fts_i_spellings = ("i", "İ", "ı")
+fts_max_phrase_spellings = 81
+
+
+def ensure_fts_index():
+    """Creates the full-text index over messages and its sync triggers if they don't exist yet.
+
+    A newly created index is populated from the existing messages. Returns whether the index is usable.
+    """
+    global fts_enabled
+    with get_con() as con:
+        if not _table_exists(con, Table.MESSAGES):
+            env.log.warning(f"No {Table.MESSAGES} table found, full-text search disabled")
+            return False
+
+        created = not _table_exists(con, Table.MESSAGES_FTS)
+        try:
+            for statement in Query.CREATE_FTS:
+                con.execute(statement)
+        except sqlite3.OperationalError as e:
+            env.log.warning(f"Could not create full-text index, falling back to REGEXP searches: {e}")
+            return False
+
+    fts_enabled = True
+    if created:
+        rebuild_fts_index()
+    return True
+
+
+def rebuild_fts_index():
+    start = time.perf_counter()
+    with get_con() as con:
+        con.execute(Query.REBUILD_FTS)
+    env.log.info(f"Rebuilt full-text index in {time.perf_counter() - start:.2f}s")
+
+
+def _fts_phrase_query(words):
+    """Returns a full-text query for messages containing the words as a phrase, or None if the full-text index can't
+    find every message `(?i)\\b<words>\\b` matches.
+
+    `unicode61` folds ASCII case the same way `re` does, except that it keeps `İ` and `ı` apart from `i`, so each `i`
+    is spelled all three ways. Phrases with non-ASCII characters or too many spellings are left to a REGEXP scan.
+    """
+    phrase = fold_case(" ".join(words))
+    if not phrase.isascii() or 3 ** phrase.count("i") > fts_max_phrase_spellings:
+        return None
+
+    spellings = [""]
+    for char in phrase:
+        spellings = [spelling + case for spelling in spellings for case in (fts_i_spellings if char == "i" else char)]
+    return " OR ".join(f'"{spelling}"' for spelling in spellings)
+
+
+def _table_exists(con, table):
+    return con.execute(Query.TABLE_EXISTS, [table]).fetchone() is not None
+
+
+def _has_index(con, table, columns):
+    for index in con.execute(f"PRAGMA index_list({table})").fetchall():
+        indexed = [row[2] for row in con.execute(f"PRAGMA index_info({index[1]})")]
+        if indexed[:len(columns)] == columns:
+            return True
+    return False
+
+
+# - Word index - #
+
+word_index_max_words = env.get_cfg("WORD_INDEX_MAX_WORDS") or 1
+word_index_enabled = False
+
+
+def message_tokens(message):
+    """Returns a JSON array of every distinct phrase of up to `word_index_max_words` words in a message, case-folded.
+
+    A phrase is a run of `\\w+` tokens separated by single spaces, folded with `fold_case`, so a phrase is listed
+    exactly when the message matches `(?i)\\b<phrase>\\b`. Registered as a SQL function for the word index's triggers.
+    """
+    if message is None:
+        return "[]"
+
+    # Folding keeps every character where it was, but not always inside `\\w`, so words are found in the original.
+    folded = fold_case(message)
+    if word_index_max_words == 1:
+        words = {folded[match.start():match.end()] for match in word_token_pattern.finditer(message)}
+        return json.dumps(list(words))
+
+    tokens = set()
+    run = []
+    previous_end = None
+    for match in word_token_pattern.finditer(message):
+        start, end = match.span()
+        if previous_end is None or message[previous_end:start] != " ":
+            run = []
+        run.append(folded[start:end])
+        previous_end = end
+        for length in range(1, min(len(run), word_index_max_words) + 1):
+            tokens.add(" ".join(run[-length:]))
+    return json.dumps(list(tokens))
+
+
+def fold_case(text):
+    """Folds case one character at a time, the way `re` compares characters case-insensitively.
+
+    Each character maps to its simple lowercase form, then to the smallest of the characters `re` treats as equal to
+    that (e.g. `ſ` to `s`). Unlike `str.lower`, this never changes the length of the text, so `İstanbul` folds to
+    `istanbul` rather than an `i` followed by a combining dot.
+    """
+    return text.translate(case_folds)
+
+
+class _CaseFolds(dict):
+    def __missing__(self, code):
+        lower = unicode_tolower(code)
+        folded = min((lower,) + extra_cases.get(lower, ()))
+        self[code] = folded
+        return folded
+
+
+case_folds = _CaseFolds()
+
+
+def ensure_word_index():
+    """Creates the per-user word counts table and its sync triggers if they don't exist yet.
+
+    A newly created index is populated from the existing messages. Returns whether the index is usable.
+    """
+    global word_index_enabled
+    with get_con() as con:
+        if not _table_exists(con, Table.MESSAGES):
+            return False
+
+        created = not _table_exists(con, Table.WORD_COUNTS)
+        try:
+            con.execute(Query.JSON_SUPPORTED).fetchall()
+            for statement in Query.CREATE_WORD_INDEX:
+                con.execute(statement)
+        except sqlite3.OperationalError as e:
+            env.log.warning(f"Could not create word index, falling back to full-text searches: {e}")
+            return False
+
+    word_index_enabled = True
+    if created:
+        rebuild_word_index()
+    return True
+
+
+def rebuild_word_index():
+    """Recounts the word index from scratch, e.g. after changing `WORD_INDEX_MAX_WORDS`."""
+
+    start = time.perf_counter()
+    with get_con() as con, transaction(con):
+        con.execute(Query.CLEAR_WORD_COUNTS)
+        con.execute(Query.REBUILD_WORD_COUNTS)
+    result_cache.bump(Table.MESSAGES)
+    env.log.info(f"Rebuilt word index in {time.perf_counter() - start:.2f}s")
+
+
+def check_word_index(sample_size=100):
+    """Compares word index leaderboards with the REGEXP scan for a sample of indexed words and phrases.
+    Args:
+        sample_size (int): How many of the most common and how many random tokens to compare.
+    Returns:
+        dict: Each mismatching phrase mapped to its (index, REGEXP) leaderboards.
+    """
+
+    with get_con() as con:
+        tokens = [row[0] for row in con.execute(Query.GET_WORD_INDEX_SAMPLE, [sample_size, sample_size])]
+
+    mismatches = {}
+    for token in tokens:
+        indexed = _get_indexed_word_leaderboard(token.split(" "))
+        scanned = _get_msg_leaderboard(f"\\b{token}\\b", True)
+        if indexed != scanned:
+            mismatches[token] = (indexed, scanned)
+    env.log.info(f"Compared {len(tokens)} word index leaderboards with REGEXP scans, {len(mismatches)} mismatches")
+    return mismatches
+
+
+def _get_indexed_word_leaderboard(words):
+    with get_con() as con:
+        rows = con.execute(Query.WORD_LEADERBOARD, [fold_case(" ".join(words))]).fetchall()
+
+    if len(rows) == 0:
+        return None
+    return {row[0]: int(row[1]) for row in rows}
+
+
+# - Bulk loading - #
+
+bulk_load_pragmas = {"synchronous": "OFF", "temp_store": "MEMORY", "cache_size": -200000}
+
+
+@contextmanager
+def bulk_load(table=None, pragmas=None, max_batch_rows=50000):
+    """Sets the database up for a large import into a table, and puts it back once the import is done.
+
+    The table's indexes and triggers are dropped for the duration and recreated once at the end by `finish_bulk_load`.
+    Their definitions are saved in the database in the same transaction as the drop, so if the import is killed before
+    they're recreated, `ensure_schema` finishes the job on the next start. The writer is restarted with relaxed PRAGMAs
+    and larger transactions. Nothing else should write to the table in the meantime.
+    Args:
+        table (str): The table being imported into, defaults to messages.
+        pragmas (dict): PRAGMAs for the writer's connection during the import, defaults to `bulk_load_pragmas`.
+        max_batch_rows (int): The most rows the writer commits per transaction during the import.
+    """
+
+    table = table or Table.MESSAGES
+    with get_con() as con, transaction(con):
+        dropped = con.execute(Query.GET_TABLE_INDEXES_AND_TRIGGERS, [table]).fetchall()
+        con.executemany(Query.SAVE_BULK_LOAD_OBJECT, dropped)
+        for object_type, name, _ in dropped:
+            con.execute(f"DROP {object_type} IF EXISTS {name}")
+
+    writer.stop()
+    saved = writer.pragmas, writer.max_batch_rows
+    writer.pragmas = {**writer.pragmas, **(pragmas or bulk_load_pragmas)}
+    writer.max_batch_rows = max_batch_rows
+    try:
+        yield
+    finally:
+        writer.stop()
+        writer.pragmas, writer.max_batch_rows = saved
+        finish_bulk_load()
+
+
+def finish_bulk_load():
+    """Recreates the indexes and triggers saved by `bulk_load`, rebuilding the full-text and word indexes if their
+    triggers were among them. Safe to run again if it's interrupted itself.
+    """
+
+    start = time.perf_counter()
+    with get_con() as con:
+        saved = con.execute(Query.GET_BULK_LOAD_OBJECTS).fetchall()
+        if len(saved) == 0:
+            return
+        for _, name, sql in saved:
+            if con.execute(Query.OBJECT_EXISTS, [name]).fetchone() is None:
+                con.execute(sql)
+
+    triggers = [name for object_type, name, _ in saved if object_type == "trigger"]
+    if any(name.startswith(Table.MESSAGES_FTS) for name in triggers):
+        rebuild_fts_index()
+    if any(name.startswith(f"{Table.WORD_COUNTS}_") for name in triggers):
+        rebuild_word_index()
+    with get_con() as con:
+        con.execute(Query.CLEAR_BULK_LOAD_OBJECTS)
+    env.log.info(f"Recreated {len(saved)} indexes and triggers after bulk load in {time.perf_counter() - start:.2f}s")
 
 
 # - Constants - #
 
 class Table:
+    BACKFILL_STATE = "backfill_state"
+    BULK_LOAD_STATE = "bulk_load_state"
     PINS = "pins"
+    PIN_AUTHOR_COUNTS = "pin_author_counts"
     MESSAGES = "messages"
+    MESSAGES_FTS = "messages_fts"
+    SEEN_EVENTS = "seen_events"
+    SYNC_STATE = "sync_state"
+    USERS = "users"
+    WORD_COUNTS = "word_counts"
 
 
 class Query:
-    GET_ALL_PINS = f"SELECT channel, timestamp, json, permalink FROM {Table.PINS} ORDER BY created_at"
-    GET_ALL_PINS_FROM_CHANNEL = f"SELECT channel, timestamp, json, permalink FROM {Table.PINS} WHERE channel COLLATE NOCASE = ? ORDER BY created_at"
-    GET_PIN = f"SELECT channel, timestamp, json, permalink FROM {Table.PINS} WHERE channel COLLATE NOCASE = ? AND timestamp = ? "
-    GET_RANDOM_PIN = f"SELECT channel, timestamp, json, permalink FROM {Table.PINS} WHERE json LIKE '%\"type\": \"message\"%' ORDER BY RANDOM() LIMIT 1"
-    GET_RANDOM_PIN_FROM_CHANNEL = f"SELECT channel, timestamp, json, permalink FROM {Table.PINS} WHERE channel COLLATE NOCASE = ? AND json LIKE '%\"type\": \"message\"%' ORDER BY RANDOM() LIMIT 1"
+    PIN_COLUMNS = "channel, timestamp, json, permalink, author_id, message_ts, text, type"
+    ANALYZE = "ANALYZE"
+    BACKFILL_PIN = f"UPDATE {Table.PINS} SET type = :type, author_id = :author_id, message_ts = :message_ts, text = :text WHERE rowid = :rowid"
+    CLEAR_BULK_LOAD_OBJECTS = f"DELETE FROM {Table.BULK_LOAD_STATE}"
+    CLEAR_PIN_AUTHOR_COUNTS = f"DELETE FROM {Table.PIN_AUTHOR_COUNTS}"
+    CLEAR_WORD_COUNTS = f"DELETE FROM {Table.WORD_COUNTS}"
+    CREATE_BULK_LOAD_STATE = f"CREATE TABLE IF NOT EXISTS {Table.BULK_LOAD_STATE} (type text not null, name text primary key, sql text not null)"
+    CREATE_FTS = [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {Table.MESSAGES_FTS} USING fts5(message, content='{Table.MESSAGES}', content_rowid='rowid', tokenize=\"unicode61 remove_diacritics 0 tokenchars '_'\")",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.MESSAGES_FTS}_insert AFTER INSERT ON {Table.MESSAGES} BEGIN INSERT INTO {Table.MESSAGES_FTS} (rowid, message) VALUES (new.rowid, new.message); END",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.MESSAGES_FTS}_delete AFTER DELETE ON {Table.MESSAGES} BEGIN INSERT INTO {Table.MESSAGES_FTS} ({Table.MESSAGES_FTS}, rowid, message) VALUES ('delete', old.rowid, old.message); END",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.MESSAGES_FTS}_update AFTER UPDATE OF message ON {Table.MESSAGES} BEGIN INSERT INTO {Table.MESSAGES_FTS} ({Table.MESSAGES_FTS}, rowid, message) VALUES ('delete', old.rowid, old.message); INSERT INTO {Table.MESSAGES_FTS} (rowid, message) VALUES (new.rowid, new.message); END",
+    ]
+    CREATE_INDEXES = [
+        f"CREATE INDEX IF NOT EXISTS {Table.PINS}_channel_type ON {Table.PINS} (channel COLLATE NOCASE, type)",
+    ]
+    CREATE_LOOKUP_INDEXES = [
+        f"CREATE INDEX IF NOT EXISTS {Table.MESSAGES}_user_name ON {Table.MESSAGES} (user_name)",
+        f"CREATE INDEX IF NOT EXISTS {Table.PINS}_channel_created_at ON {Table.PINS} (channel COLLATE NOCASE, created_at)",
+    ]
+    CREATE_MESSAGES_CHANNEL_INDEX = f"CREATE INDEX IF NOT EXISTS {Table.MESSAGES}_channel_timestamp ON {Table.MESSAGES} (channel_id, timestamp)"
+    CREATE_TABLES = [
+        f"CREATE TABLE IF NOT EXISTS {Table.BACKFILL_STATE} (channel_id text primary key, range_start real not null, range_end real not null, position real not null, cursor text, updated_at real not null)",
+        f"CREATE TABLE IF NOT EXISTS {Table.MESSAGES} (timestamp text not null, channel_id text not null, channel_name text, user_id text, user_name text, message text, permalink text, primary key (channel_id, timestamp))",
+        f"CREATE TABLE IF NOT EXISTS {Table.PIN_AUTHOR_COUNTS} (channel text COLLATE NOCASE not null, author_id text not null, count integer not null, primary key (channel, author_id))",
+        f"CREATE TABLE IF NOT EXISTS {Table.PINS} (created_by text not null, channel text not null, timestamp text not null, created_at datetime DEFAULT CURRENT_TIMESTAMP not null, json text, permalink text, type text, author_id text, message_ts text, text text, primary key (channel, timestamp))",
+        f"CREATE TABLE IF NOT EXISTS {Table.SEEN_EVENTS} (event_id text primary key, seen_at real not null)",
+        f"CREATE TABLE IF NOT EXISTS {Table.SYNC_STATE} (channel_id text primary key, high_water_mark text not null, synced_at real not null)",
+        f"CREATE TABLE IF NOT EXISTS {Table.USERS} (id text primary key, name text not null, avatar text, updated_at real not null)",
+    ]
+    CREATE_TRIGGERS = [
+        f"CREATE TRIGGER IF NOT EXISTS {Table.PINS}_count_insert AFTER INSERT ON {Table.PINS} WHEN new.author_id IS NOT NULL BEGIN "
+        f"INSERT or IGNORE INTO {Table.PIN_AUTHOR_COUNTS} (channel, author_id, count) VALUES (new.channel, new.author_id, 0); "
+        f"UPDATE {Table.PIN_AUTHOR_COUNTS} SET count = count + 1 WHERE channel = new.channel AND author_id = new.author_id; END",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.PINS}_count_delete AFTER DELETE ON {Table.PINS} WHEN old.author_id IS NOT NULL BEGIN "
+        f"UPDATE {Table.PIN_AUTHOR_COUNTS} SET count = count - 1 WHERE channel = old.channel AND author_id = old.author_id; "
+        f"DELETE FROM {Table.PIN_AUTHOR_COUNTS} WHERE channel = old.channel AND author_id = old.author_id AND count <= 0; END",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.PINS}_count_update_old AFTER UPDATE OF channel, author_id ON {Table.PINS} WHEN old.author_id IS NOT NULL BEGIN "
+        f"UPDATE {Table.PIN_AUTHOR_COUNTS} SET count = count - 1 WHERE channel = old.channel AND author_id = old.author_id; "
+        f"DELETE FROM {Table.PIN_AUTHOR_COUNTS} WHERE channel = old.channel AND author_id = old.author_id AND count <= 0; END",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.PINS}_count_update_new AFTER UPDATE OF channel, author_id ON {Table.PINS} WHEN new.author_id IS NOT NULL BEGIN "
+        f"INSERT or IGNORE INTO {Table.PIN_AUTHOR_COUNTS} (channel, author_id, count) VALUES (new.channel, new.author_id, 0); "
+        f"UPDATE {Table.PIN_AUTHOR_COUNTS} SET count = count + 1 WHERE channel = new.channel AND author_id = new.author_id; END",
+    ]
+    CREATE_WORD_INDEX = [
+        f"CREATE TABLE IF NOT EXISTS {Table.WORD_COUNTS} (token text not null, user_name text not null, count integer not null, primary key (token, user_name)) WITHOUT ROWID",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.WORD_COUNTS}_insert AFTER INSERT ON {Table.MESSAGES} BEGIN "
+        f"INSERT INTO {Table.WORD_COUNTS} (token, user_name, count) SELECT value, new.user_name, 1 FROM json_each(message_tokens(new.message)) WHERE new.user_name IS NOT NULL "
+        f"ON CONFLICT (token, user_name) DO UPDATE SET count = count + 1; END",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.WORD_COUNTS}_delete AFTER DELETE ON {Table.MESSAGES} BEGIN "
+        f"UPDATE {Table.WORD_COUNTS} SET count = count - 1 WHERE user_name = old.user_name AND token IN (SELECT value FROM json_each(message_tokens(old.message))); "
+        f"DELETE FROM {Table.WORD_COUNTS} WHERE user_name = old.user_name AND count <= 0 AND token IN (SELECT value FROM json_each(message_tokens(old.message))); END",
+        f"CREATE TRIGGER IF NOT EXISTS {Table.WORD_COUNTS}_update AFTER UPDATE OF message, user_name ON {Table.MESSAGES} BEGIN "
+        f"UPDATE {Table.WORD_COUNTS} SET count = count - 1 WHERE user_name = old.user_name AND token IN (SELECT value FROM json_each(message_tokens(old.message))); "
+        f"DELETE FROM {Table.WORD_COUNTS} WHERE user_name = old.user_name AND count <= 0 AND token IN (SELECT value FROM json_each(message_tokens(old.message))); "
+        f"INSERT INTO {Table.WORD_COUNTS} (token, user_name, count) SELECT value, new.user_name, 1 FROM json_each(message_tokens(new.message)) WHERE new.user_name IS NOT NULL "
+        f"ON CONFLICT (token, user_name) DO UPDATE SET count = count + 1; END",
+    ]
+    DELETE_BULK_LOAD_OBJECT = f"DELETE FROM {Table.BULK_LOAD_STATE} WHERE name = ?"
+    DELETE_MESSAGE = f"DELETE FROM {Table.MESSAGES} WHERE channel_id = :channel_id AND timestamp = :timestamp"
+    GET_ALL_PINS = f"SELECT {PIN_COLUMNS} FROM {Table.PINS} ORDER BY created_at"
+    GET_ALL_PINS_FROM_CHANNEL = f"SELECT {PIN_COLUMNS} FROM {Table.PINS} WHERE channel COLLATE NOCASE = ? ORDER BY created_at"
+    GET_ALL_PINS_TO_BACKFILL = f"SELECT rowid, json FROM {Table.PINS}"
+    GET_ALL_PIN_AUTHOR_COUNTS = f"SELECT channel, author_id, count FROM {Table.PIN_AUTHOR_COUNTS}"
+    GET_BACKFILL_STATE = f"SELECT channel_id, range_start, range_end, position, cursor FROM {Table.BACKFILL_STATE}"
+    GET_BACKFILL_UPDATED_AT = f"SELECT max(updated_at) FROM {Table.BACKFILL_STATE}"
+    GET_BULK_LOAD_OBJECTS = f"SELECT type, name, sql FROM {Table.BULK_LOAD_STATE} ORDER BY type"
+    GET_DATA_VERSION = "PRAGMA data_version"
+    GET_MESSAGE_PIN_ROWIDS = f"SELECT rowid FROM {Table.PINS} WHERE type = 'message'"
+    GET_MESSAGE_PIN_ROWIDS_FROM_CHANNEL = f"SELECT rowid FROM {Table.PINS} WHERE channel COLLATE NOCASE = ? AND type = 'message'"
+    GET_MESSAGES_BY_KEYS = f"SELECT timestamp, channel_id, channel_name, user_id, user_name, message, permalink FROM {Table.MESSAGES} WHERE (channel_id, timestamp) IN (VALUES {{keys}})"
+    GET_PIN = f"SELECT {PIN_COLUMNS} FROM {Table.PINS} WHERE channel COLLATE NOCASE = ? AND timestamp = ? "
+    GET_PINS_TO_BACKFILL = f"SELECT rowid, json FROM {Table.PINS} WHERE type IS NULL"
+    GET_PIN_AUTHOR_COUNTS = f"SELECT author_id, sum(count) AS total FROM {Table.PIN_AUTHOR_COUNTS} GROUP BY author_id ORDER BY total DESC, author_id"
+    GET_PIN_AUTHOR_COUNTS_FROM_CHANNEL = f"SELECT author_id, count FROM {Table.PIN_AUTHOR_COUNTS} WHERE channel = ? ORDER BY count DESC, author_id"
+    GET_PIN_BY_ROWID = f"SELECT {PIN_COLUMNS} FROM {Table.PINS} WHERE rowid = ?"
+    GET_PIN_KEYS_FROM_CHANNELS = f"SELECT channel, timestamp FROM {Table.PINS} WHERE channel COLLATE NOCASE IN ({{channels}})"
+    GET_SCHEMA_VERSION = "PRAGMA user_version"
+    GET_SEEN_EVENTS = f"SELECT event_id, seen_at FROM {Table.SEEN_EVENTS} WHERE seen_at >= ? ORDER BY seen_at"
+    GET_SYNC_STATE = f"SELECT channel_id, high_water_mark FROM {Table.SYNC_STATE}"
+    GET_TABLE_INDEXES_AND_TRIGGERS = "SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+    GET_USERS = f"SELECT id, name, avatar, updated_at FROM {Table.USERS}"
+    GET_WORD_INDEX_SAMPLE = f"SELECT token FROM (SELECT token FROM {Table.WORD_COUNTS} GROUP BY token ORDER BY sum(count) DESC LIMIT ?) UNION SELECT token FROM (SELECT DISTINCT token FROM {Table.WORD_COUNTS} ORDER BY random() LIMIT ?)"
+    JSON_SUPPORTED = "SELECT * FROM json_each('[]')"
     INSERT_MESSAGE = f"INSERT or IGNORE INTO {Table.MESSAGES} (timestamp, channel_id, channel_name, user_id, user_name, message, permalink) VALUES (:timestamp, :channel_id, :channel_name, :user_id, :user_name, :message, :permalink)"
-    INSERT_PIN = f"INSERT or IGNORE INTO {Table.PINS} (created_by, channel, timestamp, json, permalink) VALUES (?, ?, ?, ?, ?)"
-    MSG_LEADERBOARD = f"SELECT user_name, count(*) AS count FROM {Table.MESSAGES} WHERE message REGEXP ? AND user_name != 'Unknown' GROUP BY user_name ORDER BY count DESC"
-    MSG_MATCH = f"SELECT message FROM {Table.MESSAGES} WHERE message REGEXP ?"
+    INSERT_PIN = f"INSERT or IGNORE INTO {Table.PINS} (created_by, channel, timestamp, json, permalink, type, author_id, message_ts, text) VALUES (:created_by, :channel, :timestamp, :json, :permalink, :type, :author_id, :message_ts, :text)"
+    INSERT_SEEN_EVENT = f"INSERT or IGNORE INTO {Table.SEEN_EVENTS} (event_id, seen_at) VALUES (?, ?)"
+    MSG_LEADERBOARD = f"SELECT user_name, count(*) AS count FROM {Table.MESSAGES} NOT INDEXED WHERE {{filters}}message REGEXP ? AND user_name != 'Unknown' GROUP BY user_name ORDER BY count DESC"
+    MSG_LEADERBOARD_FTS = f"SELECT user_name, count(*) AS count FROM {Table.MESSAGES_FTS} JOIN {Table.MESSAGES} ON {Table.MESSAGES}.rowid = {Table.MESSAGES_FTS}.rowid WHERE {Table.MESSAGES_FTS} MATCH ? AND {Table.MESSAGES}.message REGEXP ? AND user_name != 'Unknown' GROUP BY user_name ORDER BY count DESC"
+    MSG_MATCH = f"SELECT message FROM {Table.MESSAGES} WHERE {{filters}}message REGEXP ?"
+    OBJECT_EXISTS = "SELECT 1 FROM sqlite_master WHERE name = ?"
+    OPTIMIZE = "PRAGMA optimize"
+    PRUNE_SEEN_EVENTS = f"DELETE FROM {Table.SEEN_EVENTS} WHERE seen_at < ?"
+    REBUILD_FTS = f"INSERT INTO {Table.MESSAGES_FTS} ({Table.MESSAGES_FTS}) VALUES ('rebuild')"
+    REBUILD_PIN_AUTHOR_COUNTS = f"INSERT INTO {Table.PIN_AUTHOR_COUNTS} (channel, author_id, count) SELECT min(channel), author_id, count(*) FROM {Table.PINS} WHERE author_id IS NOT NULL GROUP BY channel COLLATE NOCASE, author_id"
+    RECOUNT_PIN_AUTHORS = f"SELECT min(channel), author_id, count(*) FROM {Table.PINS} WHERE author_id IS NOT NULL GROUP BY channel COLLATE NOCASE, author_id"
+    REBUILD_WORD_COUNTS = f"INSERT INTO {Table.WORD_COUNTS} (token, user_name, count) SELECT value, user_name, count(*) FROM {Table.MESSAGES}, json_each(message_tokens({Table.MESSAGES}.message)) WHERE user_name IS NOT NULL GROUP BY value, user_name"
     REMOVE_PIN = f"DELETE FROM {Table.PINS} WHERE channel COLLATE NOCASE = ? AND timestamp = ?"
+    SAVE_BULK_LOAD_OBJECT = f"INSERT or REPLACE INTO {Table.BULK_LOAD_STATE} (type, name, sql) VALUES (?, ?, ?)"
+    SET_ANALYSIS_LIMIT = "PRAGMA analysis_limit = {limit}"
+    SET_BACKFILL_STATE = f"INSERT or REPLACE INTO {Table.BACKFILL_STATE} (channel_id, range_start, range_end, position, cursor, updated_at) VALUES (?, ?, ?, ?, ?, ?)"
+    SET_SCHEMA_VERSION = "PRAGMA user_version = {version}"
+    SET_SYNC_STATE = f"INSERT or REPLACE INTO {Table.SYNC_STATE} (channel_id, high_water_mark, synced_at) VALUES (?, ?, ?)"
+    TABLE_EXISTS = "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?"
+    UPDATE_MESSAGE = f"UPDATE {Table.MESSAGES} SET message = :message WHERE channel_id = :channel_id AND timestamp = :timestamp"
+    UPSERT_USER = f"INSERT or REPLACE INTO {Table.USERS} (id, name, avatar, updated_at) VALUES (:id, :name, :avatar, :updated_at)"
+    WORD_LEADERBOARD = f"SELECT user_name, count FROM {Table.WORD_COUNTS} WHERE token = ? AND user_name != 'Unknown' ORDER BY count DESC"
+
+
+class MessageChange:
+    INSERT = Query.INSERT_MESSAGE
+    UPDATE = Query.UPDATE_MESSAGE
+    DELETE = Query.DELETE_MESSAGE
@@ -0,0 +1,94 @@
+# External
+import threading
+import time
+from collections import OrderedDict
+
+# Internal
+import STTBot.data_interface as data_interface
+from STTBot.utils import env
+
+
+class SeenEvents:
+    """A bounded set of recently handled Slack event ids, used to drop events that Slack delivers more than once.
+
+    Ids are forgotten after `ttl` seconds, or oldest first once there are more than `max_size`. With `persist`, ids
+    are also stored in the database and reloaded on first use, so retries of events handled before a restart are
+    still recognised.
+    """
+
+    prune_interval = 1000
+
+    def __init__(self, ttl=3600, max_size=10000, persist=False):
+        self.ttl = ttl
+        self.max_size = max(1, int(max_size))
+        self.persist = persist
+        self._seen = OrderedDict()
+        self._loaded = not persist
+        self._lock = threading.Lock()
+        self._stats = {"events": 0, "duplicates": 0, "retries": 0}
+
+    def is_new(self, event_id, retry_num=None, retry_reason=None):
+        """Records an event id, returning whether it's the first time it's been seen.
+        Args:
+            event_id (str): The event's `event_id`. Events without one are always treated as new.
+            retry_num (str): The request's `X-Slack-Retry-Num` header, if any.
+            retry_reason (str): The request's `X-Slack-Retry-Reason` header, if any.
+        Returns:
+            bool: False if the event is a duplicate that shouldn't be handled again.
+        """
+
+        now = time.time()
+        with self._lock:
+            if not self._loaded:
+                self._load(now)
+            self._evict(now)
+
+            self._stats["events"] += 1
+            if retry_num is not None:
+                self._stats["retries"] += 1
+            if event_id is None:
+                return True
+
+            duplicate = event_id in self._seen
+            if duplicate:
+                self._stats["duplicates"] += 1
+                duplicate_rate = self._stats["duplicates"] / self._stats["events"]
+            else:
+                self._seen[event_id] = now
+                if len(self._seen) > self.max_size:
+                    self._seen.popitem(last=False)
+
+        if duplicate:
+            env.log.info(f"Dropped duplicate event {event_id} (retry {retry_num}, {retry_reason}), "
+                         f"{duplicate_rate:.1%} of events so far have been duplicates")
+            return False
+
+        if self.persist:
+            data_interface.add_seen_event(event_id, now)
+            if self._stats["events"] % self.prune_interval == 0:
+                data_interface.prune_seen_events(now - self.ttl)
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._seen)
+        stats["duplicate_rate"] = stats["duplicates"] / stats["events"] if stats["events"] else 0.0
+        return stats
+
+    def _evict(self, now):
+        while len(self._seen) > 0:
+            event_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl:
+                break
+            del self._seen[event_id]
+
+    def _load(self, now):
+        for event_id, seen_at in data_interface.get_seen_events(now - self.ttl)[-self.max_size:]:
+            self._seen[event_id] = seen_at
+        self._loaded = True
+
+
+seen_events = SeenEvents(ttl=env.get_cfg("EVENT_DEDUPE_TTL") or 3600,
+                         max_size=env.get_cfg("EVENT_DEDUPE_SIZE") or 10000,
+                         persist=bool(env.get_cfg("EVENT_DEDUPE_PERSIST")))
@@ -3,10 +3,13 @@ import json
 import traceback
 import datetime
 import random
-from slack_sdk.errors import SlackApiError
 
 # Internal
 import STTBot.data_interface as data_interface
+from STTBot import command_executor
+from STTBot import event_dedupe
+from STTBot import message_loader
+from STTBot import slack_directory
 from STTBot.models.command import Command
 from STTBot.models.permalink import Permalink
 from STTBot.utils import env
@@ -14,9 +17,31 @@ from STTBot.utils import env
 
 # - Top-level handlers - #
 
-def handle(client, event_data, say):
+def handle(client, event_data, say, retry_num=None, retry_reason=None):
+    """Queues a mention for the command executor, so the event is acked straight away.
+
+    Events Slack has already delivered, e.g. retries of a mention that wasn't acked in time, are dropped.
+    """
+
     if event_data["event"].get("subtype") != "bot_message":
-        return _handle_user_mention(client, event_data, say)
+        if not event_dedupe.seen_events.is_new(event_data.get("event_id"), retry_num, retry_reason):
+            return
+        try:
+            command_executor.executor.submit(_command_key(event_data), _handle_user_mention, client, event_data, say)
+        except command_executor.CommandRejected as e:
+            return _ret_error(e, say)
+
+
+def _command_key(event_data):
+    try:
+        command = Command.from_text(event_data["event"].get("text"))
+    except ValueError:
+        return None
+
+    if command.sub_cmd is not None and any(cmd['cmd'] == command.cmd and cmd['sub_cmd'] == command.sub_cmd
+                                           for cmd in commands):
+        return f"{command.cmd} {command.sub_cmd}"
+    return command.cmd
 
 
 def _handle_user_mention(client, event_data, say):
@@ -52,58 +77,49 @@ def _handle_user_mention(client, event_data, say):
 # - Pin commands - #
 
 def _cmd_pin(client, event_data, command, say):
-    users = client.users_list()
     channel = event_data["event"].get("channel")
     message = data_interface.get_random_pin(channel=channel)
 
     if message is None:
         raise CommandError("No pins found")
     
-    json_msg = message[2]
-    user = [user for user in users['members'] if user['id'] == json_msg['user']][0]['name']
-    timestamp = datetime.datetime.fromtimestamp(float(json_msg['ts']))
-    env.log.info(json_msg['text'])
-    ret_message = f"*{user}* ({timestamp.strftime('%Y-%m-%d %H:%M:%S')})\n\n{json_msg['text']}"
+    user = slack_directory.users.get_name(client, message.author_id, default=message.author_id)
+    timestamp = datetime.datetime.fromtimestamp(float(message.message_ts))
+    env.log.info(message.text)
+    ret_message = f"*{user}* ({timestamp.strftime('%Y-%m-%d %H:%M:%S')})\n\n{message.text}"
 
     return {"message": ret_message}
 
 
 def _cmd_pin_any(client, event_data, command, say):
-    users = client.users_list()
     message = data_interface.get_random_pin()
 
     if message is None:
         raise CommandError("No pins found")
 
-    json_msg = message[2]
-    user = [user for user in users['members'] if user['id'] == json_msg['user']][0]['name']
-    timestamp = datetime.datetime.fromtimestamp(float(json_msg['ts']))
-    env.log.info(json_msg['text'])
-    ret_message = f"*{user}* ({timestamp.strftime('%Y-%m-%d %H:%M:%S')})\n\n{json_msg['text']}"
+    user = slack_directory.users.get_name(client, message.author_id, default=message.author_id)
+    timestamp = datetime.datetime.fromtimestamp(float(message.message_ts))
+    env.log.info(message.text)
+    ret_message = f"*{user}* ({timestamp.strftime('%Y-%m-%d %H:%M:%S')})\n\n{message.text}"
 
     return {"message": ret_message}
 
 
 def _cmd_pin_channel(client, event_data, command, say):
-    users = client.users_list()
-
     # Get channel-id from argument in '<#channel-id|channel-name>' format.
     channel_id = command.args[0].split('|')[0][2:]
     message = data_interface.get_random_pin(channel=channel_id)
 
     if message is None:
-        channels = client.conversations_list()["channels"]
-        matching_channel = [channel for channel in channels if channel["id"].lower() == channel_id.lower()]
-        if len(matching_channel) == 0:
+        if slack_directory.channels.get(client, channel_id) is None:
             raise CommandError(f"Channel `{command.args[0]}` not found")
         else:
             raise CommandError("No pins found")
 
-    json_msg = message[2]
-    user = [user for user in users['members'] if user['id'] == json_msg['user']][0]['name']
-    timestamp = datetime.datetime.fromtimestamp(float(json_msg['ts']))
-    env.log.info(json_msg['text'])
-    ret_message = f"*{user}* ({timestamp.strftime('%Y-%m-%d %H:%M:%S')})\n\n{json_msg['text']}"
+    user = slack_directory.users.get_name(client, message.author_id, default=message.author_id)
+    timestamp = datetime.datetime.fromtimestamp(float(message.message_ts))
+    env.log.info(message.text)
+    ret_message = f"*{user}* ({timestamp.strftime('%Y-%m-%d %H:%M:%S')})\n\n{message.text}"
 
     return {"message": ret_message}
 
@@ -111,8 +127,9 @@ def _cmd_pin_channel(client, event_data, command, say):
 def _cmd_pin_add(client, event_data, command, say):
     if len(command.args) == 0:
         raise CommandError(f"Need a permalink to pin")
+    elif len(command.args) > 1:
+        return _pin_add_many(client, event_data, command.args)
 
-    message_json = "{}"
     permalink = Permalink.from_text(command.args[0])
 
     if permalink is None:
@@ -120,22 +137,41 @@ def _cmd_pin_add(client, event_data, command, say):
     elif data_interface.get_pin(permalink.channel, permalink.timestamp) is not None:
         raise CommandError("Message is already pinned")
 
-    try:
-        pin_msg_details = client.conversations_history(earliest=permalink.timestamp, latest=permalink.timestamp,
-                                                       limit=1, channel=permalink.channel, inclusive=True)
-    except SlackApiError:
-        env.log.warning("Could not find a message matching this permalink, adding with empty json")
-
-    if len(pin_msg_details['messages']) == 0:
+    message = message_loader.resolve_message(client, permalink.channel, permalink.timestamp)
+    if message is None:
         env.log.warning("Could not find a message matching this permalink, adding with empty json")
-    else:
-        message_json = json.dumps(pin_msg_details['messages'][0])
+        message = {}
 
-    data_interface.insert_pin(event_data["event"].get("user"), permalink.channel, permalink.timestamp, message_json,
-                              command.args[0])
+    data_interface.insert_pin(event_data["event"].get("user"), permalink.channel, permalink.timestamp,
+                              json.dumps(message), command.args[0]).result()
     return {"message": ":white_check_mark: Successfully added pin", "added": True}
 
 
+def _pin_add_many(client, event_data, raw_permalinks):
+    permalinks = [Permalink.from_text(raw_permalink) for raw_permalink in raw_permalinks]
+    invalid = [raw_permalink for raw_permalink, permalink in zip(raw_permalinks, permalinks) if permalink is None]
+    permalinks = [permalink for permalink in permalinks if permalink is not None]
+
+    # Skip fetching messages that are already pinned, insert_pins counts them as ignored.
+    pinned = data_interface.get_pin_keys([permalink.channel for permalink in permalinks])
+    keys = [(permalink.channel, permalink.timestamp) for permalink in permalinks
+            if (permalink.channel.lower(), permalink.timestamp) not in pinned]
+    messages = message_loader.resolve_messages(client, keys)
+    for key in keys:
+        if key not in messages:
+            env.log.warning(f"Could not find message {key[1]} in {key[0]}, adding with empty json")
+
+    pins = [(permalink.channel, permalink.timestamp,
+             json.dumps(messages.get((permalink.channel, permalink.timestamp), {})), permalink.raw_permalink)
+            for permalink in permalinks]
+    added_count, ignored_count = data_interface.insert_pins(event_data["event"].get("user"), pins)
+
+    ret_message = f":white_check_mark: Successfully added {added_count} pins and ignored {ignored_count} pins"
+    if len(invalid) > 0:
+        ret_message += f"\nSkipped invalid permalinks: {', '.join(invalid)}"
+    return {"message": ret_message, "added": added_count > 0}
+
+
 def _cmd_pin_remove(client, event_data, command, say):
     if len(command.args) == 0:
         raise CommandError(f"Need a permalink to remove")
@@ -147,51 +183,49 @@ def _cmd_pin_remove(client, event_data, command, say):
     elif data_interface.get_pin(permalink.channel, permalink.timestamp) is None:
         raise CommandError("No matching pin found")
 
-    data_interface.remove_pin(permalink.channel, permalink.timestamp)
+    data_interface.remove_pin(permalink.channel, permalink.timestamp).result()
     return {"message": ":white_check_mark: Successfully removed pin"}
 
 
 def _cmd_pin_load(client, event_data, command, say):
     msg_channel = event_data["event"].get("channel")
-    pins = client.pins_list(channel=msg_channel)
-    added_count = 0
-    ignored_count = 0
-
-    for pin in pins['items']:
-        raw_permalink = pin[pin['type']]['permalink']
-        message_json = json.dumps(pin[pin['type']])
-        env.log.info(f"Adding pin for {raw_permalink}")
+    pins = []
+    skipped_count = 0
 
+    for pin in slack_directory.paginate(client.pins_list, "items", channel=msg_channel):
         if pin['type'] == "message":
+            raw_permalink = pin['message']['permalink']
             permalink = Permalink.from_text(raw_permalink)
             channel = permalink.channel
             timestamp = permalink.timestamp
         elif pin['type'] == "file":
+            raw_permalink = pin['file']['permalink']
             channel = pin['file']['pinned_to'][0]
             timestamp = pin['file']['timestamp']
-
-        if data_interface.get_pin(permalink.channel, permalink.timestamp) is None:
-            data_interface.insert_pin(event_data["event"].get("user"), channel, timestamp, message_json, raw_permalink)
-            added_count += 1
         else:
-            ignored_count += 1
+            env.log.debug(f"Skipping pinned {pin['type']}")
+            skipped_count += 1
+            continue
+
+        pins.append((channel, timestamp, json.dumps(pin[pin['type']]), raw_permalink))
 
+    added_count, ignored_count = data_interface.insert_pins(event_data["event"].get("user"), pins)
+    ignored_count += skipped_count
     return {"message": f":white_check_mark: Successfully loaded {added_count} pins and ignored {ignored_count} pins"}
 
 
 def _cmd_pin_leaderboard(client, event_data, command, say):
-    users = client.users_list()
     if len(command.args) == 1 and command.args[0] == "all":
-        pins = data_interface.get_all_pins()
+        author_counts = data_interface.get_pin_author_counts()
     else:
         channel = event_data["event"].get("channel")
-        pins = data_interface.get_all_pins(channel=channel)
+        author_counts = data_interface.get_pin_author_counts(channel=channel)
 
-    if pins is None:
+    if author_counts is None:
         raise CommandError("No pinned items in this channel")
 
     blocks = []
-    blocks.extend(_build_top_users_block(users, pins, max_entries=5))
+    blocks.extend(_build_top_users_block(client, author_counts, max_entries=5))
 
     return {"blocks": blocks}
 
@@ -202,16 +236,16 @@ def _cmd_msg_leaderboard(client, event_data, command, say):
     if len(command.args) == 0:
         raise CommandError("Need a word to search")
     else:
-        if command.args[0] == "raw":
-            search_string = " ".join(command.args[1:])
-            display_search_string = search_string
-            ignore_case = False
-        else:
-            search_string = f"\\b{' '.join(command.args)}\\b"
-            display_search_string = search_string[2:-2]
-            ignore_case = True
+        try:
+            if command.args[0] == "raw":
+                display_search_string = " ".join(command.args[1:])
+                leaderboard = data_interface.get_msg_leaderboard(display_search_string, ignore_case=False)
+            else:
+                display_search_string = " ".join(command.args)
+                leaderboard = data_interface.get_word_leaderboard(command.args)
+        except data_interface.QueryBudgetExceeded as e:
+            raise CommandError(f"Searching for {display_search_string} is too expensive: {e}")
 
-        leaderboard = data_interface.get_msg_leaderboard(search_string, ignore_case=ignore_case)
         if leaderboard is None:
             raise CommandError(f"No matches found for {display_search_string}")
 
@@ -232,13 +266,21 @@ def _cmd_msg_match(client, event_data, command, say):
             search_string = " ".join(command.args)
             ignore_case = True
 
-        leaderboard = data_interface.get_msg_match(search_string, ignore_case=ignore_case)
+        note = ""
+        try:
+            leaderboard = data_interface.get_msg_match(search_string, ignore_case=ignore_case)
+        except data_interface.QueryBudgetExceeded as e:
+            if e.partial is None:
+                raise CommandError(f"Searching for {search_string} is too expensive: {e}")
+            leaderboard = e.partial
+            note = f":hourglass: {e}, showing partial results\n"
+
         if leaderboard is None:
             raise CommandError(f"No matches found for {search_string}")
 
         longest_string = max(len(k) for k in leaderboard.keys()) + 2
         leader_str = '\n'.join([f'{k.replace("@", "at").ljust(longest_string)} {v}' for k, v in leaderboard.items()])
-        message = f"""```{"Match".ljust(longest_string)} Count of {search_string}\n{leader_str}```"""
+        message = f"""{note}```{"Match".ljust(longest_string)} Count of {search_string}\n{leader_str}```"""
         return {"message": message}
 
 
@@ -264,42 +306,30 @@ def _cmd_stt_draft(client, event_data, command, say):
 
 # - Helper methods - #
 
-def _get_top_users(users, pins):
+def _get_top_users(client, author_counts, max_entries: int):
     """Returns dict with the necessary data to create a top users leaderboard.
 
     Args:
-        users: Return value of client.users_list().
-        pins: The set of pins to be counted.
+        client: The Slack web client, used to refresh the user directory if needed.
+        author_counts: (author_id, count) pairs, sorted by count in descending order.
+        max_entries: Maximum number of users to return.
 
     Returns:
         A dict mapping usernames to a dict containing pin count and avatar URL. For example:
         {'user1': {'count': 3, 'avatar': <url.img>}, ...}
     """
-    pin_store = {}
-    for pin in pins:
-        message = pin[2]
-        permalink = pin[3]
-        pin_store[permalink] = {}
-
-        if len(message.keys()) == 0:
-            continue
+    user_count = {}
+    for author_id, count in author_counts:
+        if len(user_count) >= max_entries:
+            break
 
-        try:
-            user = [user for user in users['members'] if user['id'] == message['user']][0]
-        except KeyError:
-            env.log.error(f"Probably couldn't get userid for {message['ts']} at {permalink}")
+        user = slack_directory.users.get(client, author_id)
+        if user is None:
+            env.log.error(f"Probably couldn't get userid for {author_id}")
             continue
 
-        pin_store[permalink]['avatar'] = user['profile']['image_192']
-        pin_store[permalink]['user'] = user['name']
-
-    user_count = {}
-    for permalink, details in pin_store.items():
-        try:
-            user_count.setdefault(details['user'], {'count': 0, 'avatar': details['avatar']})
-            user_count[details['user']]['count'] += 1
-        except KeyError:
-            env.log.error(f"Failed to count {permalink} {details}")
+        user_count.setdefault(user['name'], {'count': 0, 'avatar': user['avatar']})
+        user_count[user['name']]['count'] += count
     return user_count
 
 
@@ -355,15 +385,15 @@ def _build_stats_block(header, entries):
     return stats_block
 
 
-def _build_top_users_block(users, pins, max_entries: int):
+def _build_top_users_block(client, author_counts, max_entries: int):
     """Returns a list of Slack blocks forming a top users leaderboard.
 
     Args:
-        users: Return value of client.users_list().
-        pins: The set of pins to be counted.
+        client: The Slack web client, used to refresh the user directory if needed.
+        author_counts: (author_id, count) pairs, sorted by count in descending order.
         max_entries: Maximum number of leaderboard entries to display.
     """
-    user_count = _get_top_users(users, pins)
+    user_count = _get_top_users(client, author_counts, max_entries)
     entries = []
     for user, count_data in sorted(user_count.items(), key=lambda user: user[1]['count'], reverse=True)[:max_entries]:
         entries.append({
@@ -434,9 +464,9 @@ commands = [
         "cmd": "pin",
         "sub_cmd": "add",
         "args": [
-            "message_permalink"
+            "message_permalinks"
         ],
-        "help": "Adds a message to the database",
+        "help": "Adds one or more messages to the database",
         "func": _cmd_pin_add
     },
     {
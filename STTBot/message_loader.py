@@ -1,66 +1,276 @@
 # External
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from slack_sdk.errors import SlackApiError
 
 # Internal
 import STTBot.data_interface as data_interface
-from STTBot.utils import env
+from STTBot import slack_directory
+from STTBot.utils import env, rate_limit
 
 
 required_fields = ["ts", "user", "text"]
 scheduler = BackgroundScheduler()
 
 
-def get_messages(client):
-    midnight = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    start_time = midnight - timedelta(days=2)
-    end_time = midnight - timedelta(days=1)
-    env.log.info(f"Refreshing messages between {start_time} and {end_time}")
-    channel_response = client.conversations_list(types='public_channel,private_channel')
-    channels = {channel['id']: channel['name'] for channel in channel_response['channels']}
-    users_response = client.users_list()
-    users = {user['id']: user['name'] for user in users_response['members']}
+def sync_messages(client):
+    """Fetches every channel's messages newer than its high-water mark and stores them.
+
+    Channels that have never been synced start from `SYNC_INITIAL_DAYS` ago. A channel's high-water mark only moves
+    once all of its new messages have been stored, so a failed or missed run is caught up by the next one.
+    """
+
+    channels = slack_directory.channels.names(client)
+    users = slack_directory.users.names(client)
+    high_water_marks = data_interface.get_sync_state()
+    initial_oldest = f"{(datetime.now() - timedelta(days=env.get_cfg('SYNC_INITIAL_DAYS') or 1)).timestamp():.6f}"
+    oldest = {channel_id: high_water_marks.get(channel_id, initial_oldest) for channel_id in channels.keys()}
+    env.log.info(f"Syncing messages for {len(channels)} channels")
+
+    crawl_channels(client, channels, users, oldest)
+    job = scheduler.get_job('refresh_messages')
+    if job is not None:
+        env.log.info(f"Sync complete. Next scheduled sync is at {job.next_run_time.isoformat()}")
+
+
+def crawl_channels(client, channels, users, oldest, latest=None):
+    """Fetches the messages in a time window from every channel concurrently and stores them.
+
+    Channels are crawled by a bounded pool of workers sharing the Tier 3 rate limit. The current thread acts as the
+    single writer, inserting the crawled messages in batches and recording each fully crawled channel's newest
+    message as its high-water mark.
+    Args:
+        client: The Slack web client.
+        channels (dict): Channel ids mapped to channel names.
+        users (dict): User ids mapped to user names.
+        oldest (dict): Channel ids mapped to the timestamp to fetch messages after.
+        latest (str): Only fetch messages before this timestamp, or None for up to now.
+    """
+
+    start = time.perf_counter()
+    batches = queue.Queue()
+    workers = env.get_cfg("CRAWL_WORKERS") or 4
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crawl") as executor:
+        futures = [executor.submit(crawl_channel, client, batches, channel_id, channel_name, users,
+                                   oldest[channel_id], latest)
+                   for channel_id, channel_name in channels.items()]
+        for future in futures:
+            future.add_done_callback(lambda _: batches.put(None))
+        message_count = write_batches(batches, len(futures))
+
+    for future in futures:
+        if future.exception() is not None:
+            env.log.error(f"Channel crawl failed: {future.exception()!r}")
+    env.log.info(f"Crawled {message_count} messages from {len(channels)} channels in {time.perf_counter() - start:.2f}s")
+
+
+def crawl_channel(client, batches, channel_id, channel_name, users, oldest, latest):
+    start = time.perf_counter()
+    message_count = 0
+    high_water_mark = None
+    cursor = None
+    has_more = True
+
+    while has_more:
+        try:
+            message_response = rate_limit.call_rate_limited(rate_limit.tier_3, client.conversations_history,
+                                                            channel=channel_id, cursor=cursor, oldest=oldest,
+                                                            latest=latest, inclusive=False)
+        except SlackApiError as e:
+            env.log.error(f"Could not get messages for {channel_name}, keeping its high-water mark: {e.response}")
+            return message_count
+
+        has_more = message_response.get('has_more', False)
+        cursor = message_response.get('response_metadata', {'next_cursor': None}).get('next_cursor')
+        for message in message_response.get('messages', []):
+            if 'ts' in message and (high_water_mark is None or float(message['ts']) > float(high_water_mark)):
+                high_water_mark = message['ts']
+        messages = process_message_response(message_response, channel_id, channel_name, users)
+        batches.put(messages)
+        message_count += len(messages)
+
+    if high_water_mark is not None:
+        batches.put((channel_id, high_water_mark))
+    env.log.info(f"Processed {message_count} messages for {channel_name} in {time.perf_counter() - start:.2f}s")
+    return message_count
+
+
+def write_batches(batches, producers, batch_size=1000):
+    """Consumes the crawl queue until every producer has put its final `None`.
+
+    Lists of messages are submitted to the database writer in batches. A (channel_id, timestamp) tuple marks a channel
+    as fully crawled, and is recorded as that channel's high-water mark once everything before it has been written.
+    """
+
+    pending, writes = [], []
+    message_count = 0
+
+    while producers > 0:
+        item = batches.get()
+        if item is None:
+            producers -= 1
+        elif isinstance(item, tuple):
+            _flush(pending, writes)
+            message_count += _wait(writes)
+            data_interface.set_sync_state(*item)
+        else:
+            pending.extend(item)
+            if len(pending) >= batch_size:
+                _flush(pending, writes)
+
+    _flush(pending, writes)
+    return message_count + _wait(writes)
+
+
+def _flush(pending, writes):
+    if len(pending) > 0:
+        writes.append(data_interface.insert_messages(list(pending)))
+        pending.clear()
+
+
+def _wait(writes):
+    count = sum(write.result() for write in writes)
+    writes.clear()
+    return count
+
+
+def backfill_messages(client, start_time, end_time, chunk_days=None):
+    """Walks every channel's history between two datetimes in fixed-size chunks and stores the messages.
+
+    Progress is checkpointed per channel after every page, so an interrupted backfill over the same range resumes from
+    where it stopped. Requests go through their own rate limit of `BACKFILL_RATE` per minute, which the live bot takes
+    out of its own Tier 3 budget while a backfill is running (see `share_tier_3_with_backfill`). After a 429 the
+    backfill waits at least `BACKFILL_BACKOFF_SECONDS`, so the bot gets the budget back first.
+    Args:
+        client: The Slack web client.
+        start_time (datetime): The start of the range to backfill.
+        end_time (datetime): The end of the range to backfill.
+        chunk_days (float): The size of each chunk, defaults to `BACKFILL_CHUNK_DAYS`.
+    """
+
+    chunk = timedelta(days=chunk_days or env.get_cfg("BACKFILL_CHUNK_DAYS") or 1).total_seconds()
+    range_start, range_end = start_time.timestamp(), end_time.timestamp()
+    channels = slack_directory.channels.names(client)
+    users = slack_directory.users.names(client)
+    state = data_interface.get_backfill_state()
+    bucket = rate_limit.TokenBucket(rate=backfill_rate)
+    chunks_per_channel = max(1, math.ceil((range_end - range_start) / chunk))
+    progress = BackfillProgress(chunks_per_channel * len(channels))
+    env.log.info(f"Backfilling {len(channels)} channels between {start_time} and {end_time}")
 
     for channel_id, channel_name in channels.items():
-        oldest = f"{start_time.timestamp()}00000"
-        latest = f"{end_time.timestamp()}00000"
-        env.log.info(f"Start {oldest}, end {latest}")
-        message_count = 0
-        cursor = None
-        has_more = True
-
-        while has_more:
-            try:
-                message_response = client.conversations_history(channel=channel_id, cursor=cursor, oldest=oldest, latest=latest, inclusive=True)
-            except SlackApiError as e:
-                env.log.error(f"Could not get messages: {e.response}")
-                break
+        position, cursor = range_start, None
+        saved = state.get(channel_id)
+        if saved is not None and saved["range_start"] == range_start and saved["range_end"] == range_end:
+            position, cursor = saved["position"], saved["cursor"]
+        progress.skip(min(chunks_per_channel, math.floor((position - range_start) / chunk)))
+
+        try:
+            while position < range_end:
+                chunk_end = min(position + chunk, range_end)
+                while True:
+                    message_response = rate_limit.call_rate_limited(
+                        bucket, client.conversations_history, min_backoff=backfill_backoff, channel=channel_id,
+                        cursor=cursor, oldest=f"{position:.6f}", latest=f"{chunk_end:.6f}", inclusive=True)
+                    messages = process_message_response(message_response, channel_id, channel_name, users)
+                    data_interface.insert_messages(messages).result()
+                    progress.add_messages(len(messages))
+
+                    cursor = None
+                    if message_response.get('has_more', False):
+                        cursor = message_response.get('response_metadata', {}).get('next_cursor') or None
+                    if cursor is None:
+                        break
+                    data_interface.set_backfill_state(channel_id, range_start, range_end, position, cursor)
+
+                position = chunk_end
+                data_interface.set_backfill_state(channel_id, range_start, range_end, position, None)
+                progress.chunk_done(channel_name)
+        except SlackApiError as e:
+            env.log.error(f"Backfill of {channel_name} stopped, rerun with the same range to resume: {e.response}")
+
+    env.log.info(f"Backfill complete: {progress.message_count} messages in {progress.elapsed():.0f}s")
+
+
+backfill_rate = env.get_cfg("BACKFILL_RATE") or 20
+backfill_backoff = env.get_cfg("BACKFILL_BACKOFF_SECONDS") or 60
+# How recently a backfill must have saved its progress to count as running.
+backfill_active_seconds = 120
+backfill_active = False
+
+
+def share_tier_3_with_backfill():
+    """Lowers the bot's Tier 3 rate by `BACKFILL_RATE` while a backfill is running, so that together the two
+    processes stay within `SLACK_TIER3_RATE`.
+    """
+
+    global backfill_active
+    updated_at = data_interface.get_backfill_updated_at()
+    active = updated_at is not None and time.time() - updated_at < backfill_active_seconds
+    if active != backfill_active:
+        rate = max(1, rate_limit.tier_3_rate - backfill_rate) if active else rate_limit.tier_3_rate
+        rate_limit.tier_3.set_rate(rate)
+        backfill_active = active
+        env.log.info(f"{'A backfill is' if active else 'No backfill is'} running, Tier 3 rate set to {rate}/min")
+
+
+class BackfillProgress:
+    """Tracks backfill throughput and logs progress with an ETA."""
+
+    def __init__(self, total_chunks):
+        self.total_chunks = total_chunks
+        self.done_chunks = 0
+        self.run_chunks = 0
+        self.message_count = 0
+        self.start = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
 
-            has_more = message_response.get('has_more', False)
-            cursor = message_response.get('response_metadata', {'next_cursor': None}).get('next_cursor')
-            messages = process_message_response(message_response, channel_id, channel_name, users)
-            data_interface.insert_messages(messages)
-            message_count += len(messages)
+    def skip(self, chunks):
+        self.done_chunks += chunks
 
-        env.log.info(f"Processed {message_count} messages for {channel_name}")
-    env.log.info(f"Refresh complete. Next scheduled refresh is at {scheduler.get_job('refresh_messages').next_run_time.isoformat()}")
+    def add_messages(self, count):
+        self.message_count += count
+
+    def chunk_done(self, channel_name):
+        self.done_chunks += 1
+        self.run_chunks += 1
+        elapsed = self.elapsed()
+        eta = elapsed / self.run_chunks * (self.total_chunks - self.done_chunks)
+        env.log.info(f"Backfilled {channel_name}: {self.done_chunks}/{self.total_chunks} chunks, "
+                     f"{self.message_count} messages at {self.message_count / elapsed:.1f} msg/s, "
+                     f"ETA {timedelta(seconds=round(eta))}")
 
 
 def process_message_response(message_response, channel_id, channel_name, users):
     messages = []
     for message in message_response.get('messages', []):
-        message = resolve_missing_keys(message)
+        message = normalise_message(message, channel_id, channel_name, users)
         if message is not None:
-            permalink = f"{env.get_cfg('PERMALINK_BASE_URL')}/{channel_id}/p{message['ts'].replace('.', '')}"
-            message = {'timestamp': message['ts'], 'channel_id': channel_id, 'channel_name': channel_name,
-                       'user_id': message['user'], 'user_name': users[message['user']],
-                       'message': message['text'], 'permalink': permalink}
             messages.append(message)
 
     return messages
 
 
+def normalise_message(message, channel_id, channel_name, users):
+    """Converts a Slack message into a row for the messages table, or returns None if it can't be stored."""
+    message = resolve_missing_keys(message)
+    if message is None:
+        return None
+
+    permalink = f"{env.get_cfg('PERMALINK_BASE_URL')}/{channel_id}/p{message['ts'].replace('.', '')}"
+    return {'timestamp': message['ts'], 'channel_id': channel_id, 'channel_name': channel_name,
+            'user_id': message['user'], 'user_name': users.get(message['user'], 'Unknown'),
+            'message': message['text'], 'permalink': permalink}
+
+
 def resolve_missing_keys(message):
     missing_keys = [key for key in required_fields if key not in message.keys()]
 
@@ -74,15 +284,168 @@ def resolve_missing_keys(message):
     return message
 
 
+# - Message lookup - #
+
+def resolve_message(client, channel_id, timestamp):
+    return resolve_messages(client, [(channel_id, timestamp)]).get((channel_id, timestamp))
+
+
+def resolve_messages(client, keys):
+    """Looks messages up in the local archive, falling back to the Slack API for any it doesn't have.
+
+    Messages fetched from Slack are written back to the archive, so they're only fetched once.
+    Args:
+        client: The Slack web client.
+        keys: (channel_id, timestamp) pairs.
+    Returns:
+        dict: Each key found mapped to its message, shaped like a message from the Slack API.
+    """
+
+    keys = list(dict.fromkeys(keys))
+    messages = {key: {'type': 'message', 'user': row['user_id'], 'ts': row['timestamp'], 'text': row['message']}
+                for key, row in data_interface.get_messages(keys).items()}
+    misses = [key for key in keys if key not in messages]
+
+    fetched = []
+    for channel_id, timestamp in misses:
+        try:
+            response = rate_limit.call_rate_limited(rate_limit.tier_3, client.conversations_history,
+                                                    channel=channel_id, oldest=timestamp, latest=timestamp,
+                                                    inclusive=True, limit=1)
+        except SlackApiError as e:
+            env.log.warning(f"Could not fetch message {timestamp} in {channel_id}: {e.response}")
+            continue
+
+        found = [message for message in response.get('messages', []) if message.get('ts') == timestamp]
+        if len(found) > 0:
+            messages[(channel_id, timestamp)] = found[0]
+            fetched.append((channel_id, found[0]))
+
+    if len(fetched) > 0:
+        users = slack_directory.users.names(client)
+        rows = []
+        for channel_id, message in fetched:
+            channel = slack_directory.channels.get(client, channel_id)
+            row = normalise_message(dict(message), channel_id, channel['name'] if channel else None, users)
+            if row is not None:
+                rows.append(row)
+        data_interface.insert_messages(rows)
+
+    env.log.debug(f"Resolved {len(keys) - len(misses)} of {len(keys)} messages from the archive, "
+                  f"{len(fetched)} from Slack")
+    return messages
+
+
+# - Live ingestion - #
+
+def handle_message_event(client, event):
+    """Queues a message event from the Events API for the live writer.
+
+    New messages are normalised the same way as crawled ones. Edits and deletions update the stored message. Thread
+    replies and messages outside known channels are ignored, since the crawl wouldn't store them either.
+    """
+
+    channel = slack_directory.channels.get(client, event.get('channel', ''))
+    if channel is None:
+        return
+
+    subtype = event.get('subtype')
+    if subtype == 'message_changed':
+        message = event.get('message', {})
+        if 'ts' in message and 'text' in message:
+            live_writer.put(data_interface.MessageChange.UPDATE,
+                            {'channel_id': channel['id'], 'timestamp': message['ts'], 'message': message['text']})
+    elif subtype == 'message_deleted':
+        live_writer.put(data_interface.MessageChange.DELETE,
+                        {'channel_id': channel['id'], 'timestamp': event.get('deleted_ts')})
+    elif event.get('thread_ts', event.get('ts')) == event.get('ts') or subtype == 'thread_broadcast':
+        user_id = event.get('user')
+        users = {user_id: slack_directory.users.get_name(client, user_id, default='Unknown')}
+        message = normalise_message(dict(event), channel['id'], channel['name'], users)
+        if message is not None:
+            live_writer.put(data_interface.MessageChange.INSERT, message)
+
+
+class LiveMessageWriter:
+    """A background thread that applies queued message changes in batches.
+
+    Changes are flushed in one transaction once `batch_size` have queued up or `flush_interval` seconds have passed
+    since the first unflushed change, whichever comes first.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=2.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="live-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def put(self, kind, params):
+        self._queue.put((kind, params))
+
+    def _run(self):
+        pending = []
+        deadline = None
+        running = True
+
+        while running:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                running = False
+            elif item is not False:
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if len(pending) > 0 and (len(pending) >= self.batch_size or not running or time.monotonic() >= deadline):
+                try:
+                    data_interface.apply_message_changes(pending).result()
+                    self.written += len(pending)
+                except Exception as e:
+                    env.log.error(f"Could not write {len(pending)} live message changes: {e!r}")
+                pending = []
+                deadline = None
+
+
+live_writer = LiveMessageWriter(batch_size=env.get_cfg("LIVE_BATCH_SIZE") or 100,
+                                flush_interval=env.get_cfg("LIVE_FLUSH_SECONDS") or 2.0)
+
+
 def schedule_refresh(client):
-    midnight = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    live_writer.start()
     scheduler.add_job(
-        func=get_messages,
+        func=sync_messages,
         args=[client],
         trigger='interval',
-        days=1,
-        next_run_time=midnight,
+        minutes=env.get_cfg("SYNC_INTERVAL_MINUTES") or 15,
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
         id='refresh_messages'
     )
+    scheduler.add_job(
+        func=share_tier_3_with_backfill,
+        trigger='interval',
+        minutes=1,
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
+        id='share_tier_3'
+    )
     scheduler.start()
     return scheduler
@@ -0,0 +1,36 @@
+# External
+import json
+
+
+class Pin:
+    def __init__(self, channel, timestamp, raw_json, permalink, author_id=None, message_ts=None, text=None, type=None):
+        self.channel = channel
+        self.timestamp = timestamp
+        self.raw_json = raw_json
+        self.permalink = permalink
+        self.author_id = author_id
+        self.message_ts = message_ts
+        self.text = text
+        self.type = type
+        self._json = None
+
+    @property
+    def json(self):
+        """The pinned item's full Slack JSON, decoded on first access."""
+        if self._json is None:
+            self._json = json.loads(self.raw_json or "{}")
+        return self._json
+
+    @classmethod
+    def from_row(cls, row):
+        return Pin(*row)
+
+    @staticmethod
+    def extract_columns(message):
+        """Returns the values stored alongside a pin's JSON, extracted from the decoded message."""
+        return {
+            "author_id": message.get("user"),
+            "message_ts": message.get("ts"),
+            "text": message.get("text"),
+            "type": message.get("type") or ""
+        }
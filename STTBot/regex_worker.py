@@ -0,0 +1,27 @@
+# External
+import json
+import sys
+
+# Internal
+import STTBot.data_interface as data_interface
+
+
+def main():
+    """Answers search requests from `data_interface.RegexWorkers`, one JSON object per line on stdin and stdout."""
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            response = {"result": data_interface.guarded_searches[request["search"]](*request["args"])}
+        except data_interface.QueryBudgetExceeded as e:
+            response = {"budget": str(e), "partial": e.partial}
+        except Exception as e:
+            response = {"error": repr(e)}
+        response["regex_cache"] = data_interface.get_regex_cache_stats()
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+    data_interface.close_connections()
+
+
+if __name__ == "__main__":
+    main()
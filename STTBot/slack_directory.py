@@ -0,0 +1,188 @@
+# External
+import threading
+import time
+from slack_sdk.errors import SlackApiError
+
+# Internal
+import STTBot.data_interface as data_interface
+from STTBot.utils import env
+
+
+page_size = 200
+refresh_retry_interval = 60
+
+
+def paginate(method, key, **kwargs):
+    """Yields every item from a cursor-paginated Slack API method.
+    Args:
+        method: The client method to call, e.g. client.users_list.
+        key (str): The key of the list of items in each response.
+        kwargs: Extra arguments passed to every call.
+    """
+
+    cursor = None
+    while True:
+        response = method(cursor=cursor, limit=page_size, **kwargs)
+        yield from response.get(key, [])
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            break
+
+
+class Directory:
+    """Base class for in-process caches of Slack workspace data.
+
+    Subclasses implement `refresh`, which reloads the directory from the Slack API. The directory is refreshed on
+    first use and whenever it's older than `ttl` seconds, and can be invalidated early, e.g. from an event listener.
+    """
+
+    name = "entries"
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, client):
+        raise NotImplementedError
+
+    def invalidate(self):
+        self.loaded_at = 0
+
+    def is_fresh(self):
+        return self.loaded_at is not None and time.time() - self.loaded_at < self.ttl
+
+    def is_empty(self):
+        raise NotImplementedError
+
+    def _ensure_fresh(self, client):
+        if self.is_fresh():
+            return
+
+        with self._lock:
+            if self.loaded_at is None:
+                self._load_persisted()
+            if self.is_fresh():
+                return
+            try:
+                start = time.perf_counter()
+                self.refresh(client)
+                self.loaded_at = time.time()
+                env.log.info(f"Loaded {self.name} directory in {time.perf_counter() - start:.2f}s")
+            except SlackApiError as e:
+                if self.is_empty():
+                    raise
+                env.log.error(f"Could not refresh {self.name}, keeping cached directory: {e.response}")
+                self.loaded_at = time.time() - self.ttl + refresh_retry_interval
+
+    def _load_persisted(self):
+        pass
+
+
+class UserDirectory(Directory):
+    """An in-process cache of the workspace's users, keyed by user id.
+
+    The directory is loaded from the persisted `users` table on first use so restarts are warm.
+    """
+
+    name = "user"
+
+    def __init__(self, ttl=3600):
+        super().__init__(ttl=ttl)
+        self._users = {}
+
+    def get(self, client, user_id):
+        """Gets a user's profile.
+        Args:
+            client: The Slack web client, used if the directory needs refreshing.
+            user_id (str): The Slack user id.
+        Returns:
+            dict: The user's id, name and avatar, or None if the user isn't known.
+        """
+
+        self._ensure_fresh(client)
+        return self._users.get(user_id)
+
+    def get_name(self, client, user_id, default=None):
+        user = self.get(client, user_id)
+        return user["name"] if user is not None else default
+
+    def names(self, client):
+        self._ensure_fresh(client)
+        return {user_id: user["name"] for user_id, user in self._users.items()}
+
+    def is_empty(self):
+        return len(self._users) == 0
+
+    def refresh(self, client):
+        now = time.time()
+        users = {}
+        for member in paginate(client.users_list, "members"):
+            users[member["id"]] = {"id": member["id"], "name": member["name"],
+                                   "avatar": member.get("profile", {}).get("image_192"), "updated_at": now}
+
+        data_interface.upsert_users(list(users.values()))
+        self._users = users
+
+    def _load_persisted(self):
+        persisted = data_interface.get_users()
+        if len(persisted) == 0:
+            return
+        self._users = {user["id"]: user for user in persisted}
+        self.loaded_at = min(user["updated_at"] for user in persisted)
+
+
+class ChannelDirectory(Directory):
+    """An in-process cache of the workspace's channels, indexed by id and by name.
+
+    Besides refreshing from `conversations.list`, the directory can be loaded from a Slack export's `channels.json`
+    for offline use.
+    """
+
+    name = "channel"
+    types = "public_channel,private_channel"
+
+    def __init__(self, ttl=3600):
+        super().__init__(ttl=ttl)
+        self._by_id = {}
+        self._by_name = {}
+
+    def get(self, client, channel_id):
+        self._ensure_fresh(client)
+        return self._by_id.get(channel_id.upper())
+
+    def get_by_name(self, client, name):
+        self._ensure_fresh(client)
+        return self._by_name.get(name.lower())
+
+    def names(self, client):
+        self._ensure_fresh(client)
+        return {channel_id: channel["name"] for channel_id, channel in self._by_id.items()}
+
+    def is_empty(self):
+        return len(self._by_id) == 0
+
+    def refresh(self, client):
+        self.load(paginate(client.conversations_list, "channels", types=self.types))
+
+    def load(self, channels, ttl=None):
+        """Replaces the directory's contents with the given channels.
+        Args:
+            channels: Channel dicts with at least `id` and `name`, from the API or a Slack export.
+            ttl (float): If given, how long the loaded data stays fresh for.
+        """
+
+        by_id, by_name = {}, {}
+        for channel in channels:
+            entry = {"id": channel["id"], "name": channel["name"]}
+            by_id[entry["id"].upper()] = entry
+            by_name[entry["name"].lower()] = entry
+
+        self._by_id, self._by_name = by_id, by_name
+        if ttl is not None:
+            self.ttl = ttl
+        self.loaded_at = time.time()
+
+
+users = UserDirectory(ttl=env.get_cfg("USER_DIRECTORY_TTL") or 3600)
+channels = ChannelDirectory(ttl=env.get_cfg("CHANNEL_DIRECTORY_TTL") or 3600)
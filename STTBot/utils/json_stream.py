@@ -0,0 +1,94 @@
+# External
+import json
+
+
+chunk_size = 2**16
+decoder = json.JSONDecoder()
+whitespace = " \t\r\n"
+
+
+def iter_json_array(filepath, chunk_size=chunk_size):
+    """Yields the elements of a file's top-level JSON array one at a time, without loading the whole file.
+
+    The file is read in chunks and each element is decoded as soon as it's complete, so memory use is bounded by the
+    largest single element rather than the size of the file. When an element spans several chunks, the amount read
+    doubles each time so large elements aren't re-decoded over and over.
+    Args:
+        filepath (str): The path to a UTF-8 JSON file whose top-level value is an array.
+        chunk_size (int): How many characters to read at a time.
+    """
+
+    with open(filepath, 'r', encoding='utf8') as f:
+        buffer, pos, eof = "", 0, False
+        offset = 0
+        read_size = chunk_size
+        # What comes next: the opening bracket, the first element or `]`, an element after a comma, or `,` or `]`.
+        expect = "array"
+
+        while True:
+            pos = _skip(buffer, pos, whitespace)
+            if pos < len(buffer):
+                char = buffer[pos]
+                if expect == "array":
+                    if char != "[":
+                        raise ValueError(f"{filepath} doesn't contain a JSON array")
+                    expect, pos = "first", pos + 1
+                    continue
+                if expect == "delimiter":
+                    if char == "]":
+                        _check_end(f, filepath, buffer, pos + 1, offset)
+                        return
+                    if char != ",":
+                        raise ValueError(f"{filepath} has invalid JSON at character {offset + pos}")
+                    expect, pos = "element", pos + 1
+                    continue
+                if char == "]" and expect == "first":
+                    _check_end(f, filepath, buffer, pos + 1, offset)
+                    return
+                if char in ",]":
+                    raise ValueError(f"{filepath} has invalid JSON at character {offset + pos}")
+
+                try:
+                    element, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    # Only trust an element once its delimiter is in sight, since a number cut off at the end of the
+                    # buffer (e.g. `1.` of `1.5`) still decodes.
+                    delimiter = _skip(buffer, end, whitespace)
+                    if delimiter < len(buffer) and buffer[delimiter] in ",]":
+                        yield element
+                        expect, pos = "delimiter", end
+                        read_size = chunk_size
+                        continue
+                    if eof and delimiter < len(buffer):
+                        raise ValueError(f"{filepath} has invalid JSON at character {offset + delimiter}")
+            if eof:
+                raise ValueError(f"{filepath} ended before its JSON array was closed")
+
+            chunk = f.read(read_size)
+            eof = len(chunk) == 0
+            buffer = buffer[pos:] + chunk
+            offset += pos
+            pos = 0
+            if not eof and len(buffer) > read_size:
+                read_size *= 2
+
+
+def _check_end(f, filepath, buffer, pos, offset):
+    while True:
+        pos = _skip(buffer, pos, whitespace)
+        if pos < len(buffer):
+            raise ValueError(f"{filepath} has data after its JSON array at character {offset + pos}")
+        offset += len(buffer)
+        buffer, pos = f.read(chunk_size), 0
+        if len(buffer) == 0:
+            return
+
+
+def _skip(buffer, pos, characters):
+    length = len(buffer)
+    while pos < length and buffer[pos] in characters:
+        pos += 1
+    return pos
@@ -0,0 +1,76 @@
+# External
+import threading
+import time
+from slack_sdk.errors import SlackApiError
+
+# Internal
+from STTBot.utils import env
+
+
+class TokenBucket:
+    """A thread-safe token bucket shared by every caller of a rate-limited API.
+
+    Tokens refill continuously at `rate` per minute up to `burst`. `pause` stops handing out tokens to anyone until the
+    given number of seconds has passed, for when the API asks us to back off.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate / 60.0
+        self.burst = burst or max(1, int(rate / 10))
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.rate = rate / 60.0
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def call_rate_limited(bucket, method, max_retries=5, min_backoff=0, **kwargs):
+    """Calls a Slack API method once a token is available, retrying after `Retry-After` on a 429 response.
+    Args:
+        bucket (TokenBucket): The bucket shared by every caller of this API tier.
+        method: The client method to call.
+        max_retries (int): How many rate-limited responses to retry before giving up.
+        min_backoff (float): The fewest seconds to wait after a 429, for callers that should give way to others.
+        kwargs: Arguments passed to the method.
+    Returns:
+        The method's response.
+    """
+
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        try:
+            return method(**kwargs)
+        except SlackApiError as e:
+            if getattr(e.response, "status_code", None) != 429 or attempt == max_retries:
+                raise
+            retry_after = max(min_backoff, float(e.response.headers.get("Retry-After", 1)))
+            env.log.warning(f"Rate limited by Slack, retrying in {retry_after}s")
+            bucket.pause(retry_after)
+
+
+# Slack's Tier 3 methods (e.g. conversations.history) allow 50+ requests per minute.
+tier_3_rate = env.get_cfg("SLACK_TIER3_RATE") or 50
+tier_3 = TokenBucket(rate=tier_3_rate)
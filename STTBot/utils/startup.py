@@ -13,6 +13,26 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Slack bot for various STT functions")
     parser.add_argument("--debug", action="store_true", help="Show debug-level logging")
     parser.add_argument("--env", default=".env.prod.json", help="Path to the config file to use")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help="Rebuild the message full-text index and exit (load_messages.py only)")
+    parser.add_argument("--backfill", nargs=2, metavar=("START", "END"),
+                        help="Backfill messages from the Slack API between two YYYY-MM-DD dates, resuming an "
+                             "interrupted backfill of the same range (load_messages.py only)")
+    parser.add_argument("--check-pin-counts", action="store_true",
+                        help="Compare the pin leaderboard counts with a full recount, repair them and exit "
+                             "(load_messages.py only)")
+    parser.add_argument("--fast-import", action="store_true",
+                        help="Import the Slack export with a process pool and bulk transactions, rebuilding indexes "
+                             "once at the end (load_messages.py only)")
+    parser.add_argument("--rebuild-word-index", action="store_true",
+                        help="Recount the per-user word index used by `msg leaderboard` and exit "
+                             "(load_messages.py only)")
+    parser.add_argument("--check-word-index", action="store_true",
+                        help="Compare word index leaderboards with full REGEXP scans for a sample of words and exit "
+                             "(load_messages.py only)")
+    parser.add_argument("--explain-queries", action="store_true",
+                        help="Show SQLite's query plan for every query the bot runs and exit (load_messages.py only)")
+    parser.add_argument("--data-path", help="Path to the unzipped Slack export to import (load_messages.py only)")
     return parser.parse_args()
 
 
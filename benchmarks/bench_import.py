@@ -0,0 +1,123 @@
+"""
+Benchmarks load_messages.py against a generated Slack export.
+
+    python3.7 benchmarks/bench_import.py --env .env.prod.json --size-mb 2048 --modes fast default
+
+Each mode imports into its own fresh database next to the export, with every other setting taken from the given config.
+"""
+
+# External
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+words = ("lol the cat dog hello world yes no maybe tomorrow lunch meeting deploy build broken fixed again why how "
+         "great thanks ok sure nope coffee friday weekend release ticket review merge").split()
+users = [(f"U{i:08d}", f"user{i}") for i in range(200)]
+create_messages_table = ("CREATE TABLE messages (timestamp text not null, channel_id text not null, "
+                         "channel_name text, user_id text, user_name text, message text, permalink text, "
+                         "primary key (channel_id, timestamp))")
+
+
+def generate_export(path, size_mb, channel_count, messages_per_day, attachment_bytes):
+    """Writes a Slack export of roughly `size_mb` megabytes, spread evenly over the channels day by day."""
+
+    channels = [{"id": f"C{i:08d}", "name": f"channel-{i}"} for i in range(channel_count)]
+    with open(os.path.join(path, "channels.json"), "w", encoding="utf8") as f:
+        json.dump(channels, f)
+
+    random.seed(0)
+    filler = "x" * attachment_bytes
+    written, day = 0, datetime(2015, 1, 1)
+    while written < size_mb * 2**20:
+        for channel in channels:
+            channel_dir = os.path.join(path, channel["name"])
+            os.makedirs(channel_dir, exist_ok=True)
+            messages = []
+            for i in range(messages_per_day):
+                user_id, user_name = random.choice(users)
+                messages.append({
+                    "type": "message", "ts": f"{day.timestamp() + i:.6f}", "user": user_id,
+                    "text": " ".join(random.choice(words) for _ in range(random.randint(3, 20))),
+                    "user_profile": {"name": user_name, "real_name": user_name.title(), "image_72": filler[:80]},
+                    "blocks": [{"type": "rich_text", "elements": [{"type": "text", "text": filler}]}],
+                })
+            data = json.dumps(messages)
+            with open(os.path.join(channel_dir, f"{day:%Y-%m-%d}.json"), "w", encoding="utf8") as f:
+                f.write(data)
+            written += len(data)
+        day += timedelta(days=1)
+    return written
+
+
+def run_import(mode, export_path, config, work_path):
+    db_path = os.path.join(work_path, f"{mode}.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    with sqlite3.connect(db_path) as con:
+        con.execute(create_messages_table)
+
+    config_path = os.path.join(work_path, f"{mode}.json")
+    with open(config_path, "w") as f:
+        json.dump({**config, "PATH_DB": db_path}, f)
+
+    command = [sys.executable, os.path.join(root, "load_messages.py"), "--env", config_path, "--data-path", export_path]
+    if mode == "fast":
+        command.append("--fast-import")
+
+    start = time.perf_counter()
+    subprocess.run(command, check=True)
+    elapsed = time.perf_counter() - start
+
+    with sqlite3.connect(db_path) as con:
+        rows = con.execute("SELECT count(*) FROM messages").fetchone()[0]
+    return elapsed, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark importing a generated Slack export")
+    parser.add_argument("--env", required=True, help="Config file to base each run's config on")
+    parser.add_argument("--size-mb", type=float, default=2048, help="Approximate size of the generated export")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--messages-per-day", type=int, default=200)
+    parser.add_argument("--attachment-bytes", type=int, default=1500, help="Size of each message's block payload")
+    parser.add_argument("--modes", nargs="+", choices=["fast", "default"], default=["fast", "default"])
+    parser.add_argument("--work-path", help="Directory for the export and databases, defaults to a temporary one")
+    args = parser.parse_args()
+
+    with open(args.env) as f:
+        config = json.load(f)
+
+    work_path = args.work_path or tempfile.mkdtemp(prefix="sttbot-bench-")
+    export_path = os.path.join(work_path, "export")
+    try:
+        if not os.path.exists(os.path.join(export_path, "channels.json")):
+            os.makedirs(export_path, exist_ok=True)
+            start = time.perf_counter()
+            size = generate_export(export_path, args.size_mb, args.channels, args.messages_per_day,
+                                   args.attachment_bytes)
+            print(f"Generated {size / 2**20:.0f} MB export in {time.perf_counter() - start:.1f}s")
+        size = sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(export_path) for name in names)
+
+        for mode in args.modes:
+            elapsed, rows = run_import(mode, export_path, config, work_path)
+            print(f"{mode:>8}: {rows} messages in {elapsed:.1f}s, {rows / elapsed:.0f} msg/s, "
+                  f"{size / 2**20 / elapsed:.1f} MB/s")
+    finally:
+        if args.work_path is None:
+            shutil.rmtree(work_path)
+
+
+if __name__ == "__main__":
+    main()
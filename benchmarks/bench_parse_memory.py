@@ -0,0 +1,84 @@
+"""
+Compares peak memory of loading an export day file whole against streaming it with json_stream.
+
+    python3.7 benchmarks/bench_parse_memory.py --size-mb 500
+
+Each path runs in its own process and keeps the same slimmed-down rows the importer keeps, so the difference is the
+memory the full parse holds on to.
+"""
+
+# External
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+parse_paths = {
+    "load": "import json\n"
+            "with open(path, encoding='utf8') as f:\n"
+            "    messages = json.load(f)\n",
+    "stream": "from STTBot.utils import json_stream\n"
+              "messages = json_stream.iter_json_array(path)\n",
+}
+measure = """
+import resource, sys, time
+path = sys.argv[1]
+start = time.perf_counter()
+{parse}
+rows = [(m.get('ts'), m.get('user'), m.get('text'), m.get('user_profile', {{}}).get('name')) for m in messages]
+print(len(rows), time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def generate_day_file(path, size_mb, attachment_bytes):
+    """Writes one day file of roughly `size_mb` megabytes, streaming it out so the generator itself stays small."""
+
+    random.seed(0)
+    filler = "x" * attachment_bytes
+    written, i = 0, 0
+    with open(path, "w", encoding="utf8") as f:
+        f.write("[")
+        while written < size_mb * 2**20:
+            message = {"type": "message", "ts": f"{1420070400 + i}.000100", "user": f"U{i % 200:08d}",
+                       "text": f"message {i} {random.random()}", "user_profile": {"name": f"user{i % 200}"},
+                       "attachments": [{"fallback": filler, "blocks": [{"type": "section", "text": filler}]}]}
+            data = ("," if i > 0 else "") + json.dumps(message)
+            f.write(data)
+            written += len(data)
+            i += 1
+        f.write("]")
+    return written, i
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare peak memory of whole-file and streaming JSON parsing")
+    parser.add_argument("--size-mb", type=float, default=500, help="Approximate size of the generated day file")
+    parser.add_argument("--attachment-bytes", type=int, default=4000, help="Size of each message's attachment")
+    parser.add_argument("--paths", nargs="+", choices=list(parse_paths), default=list(parse_paths))
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(prefix="sttbot-bench-", suffix=".json")
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        size, count = generate_day_file(path, args.size_mb, args.attachment_bytes)
+        print(f"Generated {size / 2**20:.0f} MB file with {count} messages in {time.perf_counter() - start:.1f}s")
+
+        for name in args.paths:
+            script = measure.format(parse=parse_paths[name])
+            output = subprocess.run([sys.executable, "-c", script, path], cwd=root, check=True,
+                                    stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+            rows, elapsed, max_rss = int(output[0]), float(output[1]), int(output[2])
+            print(f"{name:>8}: {rows} messages in {elapsed:.1f}s, peak RSS {max_rss / 1024:.0f} MB")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Measures the per-row cost of the REGEXP function on a generated messages table.
+
+    python3.7 benchmarks/bench_regexp.py --rows 200000 --patterns "\\blol\\b" "l+ol"
+
+`before` compiles the pattern on every row, as the REGEXP function originally did; `after` is the cached
+`data_interface.regexp`. Both run the same full-table count, so the difference is the per-row callback cost.
+"""
+
+# External
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+words = ("lol the cat dog hello world yes no maybe tomorrow lunch meeting deploy build broken fixed again why how "
+         "great thanks ok sure nope coffee friday weekend release ticket review merge lolol LOL").split()
+create_messages_table = ("CREATE TABLE messages (timestamp text not null, channel_id text not null, "
+                         "channel_name text, user_id text, user_name text, message text, permalink text, "
+                         "primary key (channel_id, timestamp))")
+measure = """
+import json, re, sqlite3, sys, time
+from STTBot import data_interface
+
+
+def before(expr, item):
+    return re.compile(expr, re.IGNORECASE).search(item) is not None
+
+
+functions = {{"before": (before, "{{}}"), "after": (data_interface.regexp, "(?i){{}}")}}
+con = sqlite3.connect(data_interface.db)
+rows = con.execute("SELECT count(*) FROM messages").fetchone()[0]
+results = []
+for pattern in json.loads(sys.stdin.read()):
+    for name in {paths}:
+        func, expr = functions[name]
+        con.create_function("REGEXP", 2, func)
+        times = []
+        for _ in range({repeat}):
+            start = time.perf_counter()
+            matched = con.execute("SELECT count(*) FROM messages WHERE message REGEXP ?",
+                                  [expr.format(pattern)]).fetchone()[0]
+            times.append(time.perf_counter() - start)
+        results.append([pattern, name, matched, min(times) / rows])
+print(json.dumps(results))
+"""
+
+
+def generate_messages(path, rows):
+    random.seed(0)
+    with sqlite3.connect(path) as con:
+        con.execute(create_messages_table)
+        con.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            (f"{1420070400 + i}.000100", f"C{i % 20:08d}", f"channel-{i % 20}", f"U{i % 200:08d}", f"user{i % 200}",
+             " ".join(random.choice(words) for _ in range(random.randint(3, 20))), "")
+            for i in range(rows)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-row cost of the REGEXP function")
+    parser.add_argument("--rows", type=int, default=200000, help="Messages in the generated table")
+    parser.add_argument("--patterns", nargs="+", default=[r"\blol\b", "l+ol", "deploy.*broken"])
+    parser.add_argument("--paths", nargs="+", choices=["before", "after"], default=["before", "after"])
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per pattern, the fastest is reported")
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix="sttbot-bench-")
+    try:
+        db_path = os.path.join(work_path, "messages.db")
+        config_path = os.path.join(work_path, "config.json")
+        generate_messages(db_path, args.rows)
+        with open(config_path, "w") as f:
+            json.dump({"PATH_DB": db_path}, f)
+
+        script = measure.format(paths=args.paths, repeat=args.repeat)
+        output = subprocess.run([sys.executable, "-c", script, "--env", config_path], input=json.dumps(args.patterns),
+                                cwd=root, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        for pattern, name, matched, per_row in json.loads(output.splitlines()[-1]):
+            print(f"{pattern!r:>20} {name:>7}: {per_row * 1e6:.3f} us/row ({matched} of {args.rows} rows matched)")
+    finally:
+        shutil.rmtree(work_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,22 @@
 # External
 import os
-import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
+from slack_sdk import WebClient
+from slack_sdk.oauth.installation_store.sqlite3 import SQLite3InstallationStore
 
 # Internal
 from STTBot import data_interface
+from STTBot import message_loader
+from STTBot import slack_directory
 from STTBot.utils import env
+from STTBot.utils import json_stream
 
 # Global variables
 db = env.get_cfg("PATH_DB")
-data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../data")
+data_path = env.get_arg("data_path") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "../data")
 required_fields = ["ts", "user", "text"]
 inserted_message_counts = {}
 
@@ -19,35 +26,107 @@ scheduler = BackgroundScheduler()
 
 def main():
     channel_dirs = [d.name for d in os.scandir(data_path) if d.is_dir()]
-    channel_info = get_json_from_file(os.path.join(data_path, "channels.json"))
+    channels = slack_directory.ChannelDirectory(ttl=float("inf"))
+    channels.load(json_stream.iter_json_array(os.path.join(data_path, "channels.json")))
 
     for channel_dir in [os.path.join(data_path, channel_dir) for channel_dir in channel_dirs]:
         channel_name = os.path.basename(channel_dir)
-        channel_id = [channel['id'] for channel in channel_info if channel['name'] == channel_name][0]
+        channel_id = channels.get_by_name(None, channel_name)['id']
         env.log.info(f"Getting messages for {channel_name}")
+        writes = []
 
         for message_file in os.scandir(channel_dir):
-            message_data = process_message_file(message_file, channel_id)
-            for message in message_data:
-                message['channel_id'] = channel_id
-                message['channel_name'] = channel_name
-            data_interface.insert_messages(message_data)
+            message_data = process_message_file(message_file, channel_id, channel_name)
+            writes.append(data_interface.insert_messages(message_data))
             inserted_message_counts[channel_name] = inserted_message_counts.get(channel_name, 0) + len(message_data)
 
+        for write in writes:
+            write.result()
         env.log.info(f"Inserted/updated {inserted_message_counts[channel_name]} messages for {channel_name}")
 
 
-def process_message_file(filepath, channel_id):
-    message_file_json = get_json_from_file(filepath)
+def fast_import(workers=None, batch_size=50000, max_pending_writes=4):
+    """Imports the Slack export with day files parsed in a process pool and rows streamed to the database writer.
+
+    The import runs inside `data_interface.bulk_load`, so transactions are large, PRAGMAs are relaxed and the messages
+    table's indexes and triggers are only rebuilt once at the end. At most two files per worker are parsed ahead of
+    the writer, and parsing waits while more than `max_pending_writes` write jobs are queued, so memory use doesn't
+    grow with the size of the export.
+    Args:
+        workers (int): The number of parser processes, defaults to `IMPORT_WORKERS` or the CPU count.
+        batch_size (int): The number of messages per write job.
+        max_pending_writes (int): How many write jobs may be queued before parsing waits for the writer.
+    """
+
+    start = time.perf_counter()
+    channels = slack_directory.ChannelDirectory(ttl=float("inf"))
+    channels.load(json_stream.iter_json_array(os.path.join(data_path, "channels.json")))
+
+    tasks = []
+    for channel_dir in os.scandir(data_path):
+        if channel_dir.is_dir():
+            channel = channels.get_by_name(None, channel_dir.name)
+            tasks.extend((message_file.path, channel['id'], channel['name']) for message_file in os.scandir(channel_dir))
+    total_bytes = sum(os.path.getsize(task[0]) for task in tasks)
+    env.log.info(f"Importing {len(tasks)} files ({total_bytes / 2**20:.1f} MB) from {data_path}")
+
+    workers = workers or env.get_cfg("IMPORT_WORKERS") or os.cpu_count()
+    remaining = iter(tasks)
+    in_flight = {}
+    pending, writes = [], []
+    message_count = 0
+    with data_interface.bulk_load():
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(in_flight) < workers * 2:
+                    task = next(remaining, None)
+                    if task is None:
+                        break
+                    in_flight[executor.submit(_process_task, task)] = task
+                if len(in_flight) == 0:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    message_data = future.result()
+                    inserted_message_counts[task[2]] = inserted_message_counts.get(task[2], 0) + len(message_data)
+                    message_count += len(message_data)
+                    pending.extend(message_data)
+                    if len(pending) >= batch_size:
+                        writes.append(data_interface.insert_messages(pending))
+                        pending = []
+                while len(writes) > max_pending_writes:
+                    writes.pop(0).result()
+
+        writes.append(data_interface.insert_messages(pending))
+        for write in writes:
+            write.result()
+        load_elapsed = time.perf_counter() - start
+
+    elapsed = time.perf_counter() - start
+    env.log.info(f"Imported {message_count} messages from {len(tasks)} files ({total_bytes / 2**20:.1f} MB) in "
+                 f"{elapsed:.1f}s: {message_count / load_elapsed:.0f} msg/s and "
+                 f"{total_bytes / 2**20 / load_elapsed:.1f} MB/s while loading, "
+                 f"{elapsed - load_elapsed:.1f}s rebuilding indexes")
+
+
+def _process_task(task):
+    return process_message_file(*task)
+
+
+def process_message_file(filepath, channel_id, channel_name):
+    permalink_base = f"{env.get_cfg('PERMALINK_BASE_URL')}/{channel_id}/p"
 
     message_data = []
-    for message in message_file_json:
+    for message in iter_messages(filepath):
         message = resolve_missing_keys(message)
         if message is None:
             continue
 
-        permalink = f"{env.get_cfg('PERMALINK_BASE_URL')}/{channel_id}/p{message['ts'].replace('.', '')}"
-        message = {'timestamp': message['ts'], 'user_id': message['user'], 'user_name': message['user_profile']['name'], 'message': message['text'], 'permalink': permalink}
+        message = {'timestamp': message['ts'], 'channel_id': channel_id, 'channel_name': channel_name,
+                   'user_id': message['user'], 'user_name': message['user_profile']['name'],
+                   'message': message['text'], 'permalink': permalink_base + message['ts'].replace('.', '')}
         message_data.append(message)
 
     return message_data
@@ -66,9 +145,45 @@ def resolve_missing_keys(message):
     return message
 
 
-def get_json_from_file(filepath):
-    with open(filepath, 'r', encoding='utf8') as f:
-        return json.load(f)
+def iter_messages(filepath):
+    """Streams the messages in an export day file, keeping only the fields the importer uses."""
+    for message in json_stream.iter_json_array(filepath):
+        slim = {key: message[key] for key in required_fields if key in message}
+        if 'name' in message.get('user_profile', {}):
+            slim['user_profile'] = {'name': message['user_profile']['name']}
+        yield slim
+
+
+def backfill(start_date, end_date):
+    installation_store = SQLite3InstallationStore(database=db, client_id=env.get_cfg("SLACK_CLIENT_ID"))
+    installation = installation_store.find_installation(team_id=env.get_cfg("AUTH_TEAM_ID"), enterprise_id=None)
+    if installation is None:
+        env.log.error("Can't find matching installation, either AUTH_TEAM_ID is not set or the bot isn't installed")
+        return
+
+    client = WebClient(token=installation.bot_token)
+    message_loader.backfill_messages(client, datetime.strptime(start_date, "%Y-%m-%d"),
+                                     datetime.strptime(end_date, "%Y-%m-%d"))
+
+
+def check_pin_counts():
+    mismatches = data_interface.check_pin_author_counts(repair=True)
+    for (channel, author_id), (materialized, recounted) in sorted(mismatches.items()):
+        env.log.warning(f"Pin count for {author_id} in {channel} was {materialized}, recounted {recounted}")
+    env.log.info(f"Pin counts checked, {len(mismatches)} mismatches{' repaired' if mismatches else ''}")
+
+
+def check_word_index():
+    if not data_interface.word_index_enabled:
+        env.log.warning("The word index isn't available, nothing to check")
+        return
+    for token, (indexed, scanned) in data_interface.check_word_index().items():
+        env.log.warning(f"Word index mismatch for `{token}`: index {indexed}, REGEXP {scanned}")
+
+
+def explain_queries():
+    for name, plan in data_interface.explain_queries().items():
+        env.log.info(f"{name}:\n    " + "\n    ".join(plan or ["(no table lookups)"]))
 
 
 def log_inserted_counts():
@@ -76,7 +191,32 @@ def log_inserted_counts():
 
 
 if __name__ == "__main__":
-    scheduler.add_job(log_inserted_counts, trigger='interval', minutes=1)
-    scheduler.start()
-    main()
-    scheduler.shutdown()
+    if env.get_arg("rebuild_index"):
+        if data_interface.ensure_schema():
+            data_interface.rebuild_fts_index()
+    elif env.get_arg("rebuild_word_index"):
+        data_interface.ensure_schema()
+        if data_interface.word_index_enabled:
+            data_interface.rebuild_word_index()
+    elif env.get_arg("check_word_index"):
+        data_interface.ensure_schema()
+        check_word_index()
+    elif env.get_arg("explain_queries"):
+        data_interface.ensure_schema()
+        explain_queries()
+    elif env.get_arg("backfill"):
+        data_interface.ensure_schema()
+        backfill(*env.get_arg("backfill"))
+    elif env.get_arg("check_pin_counts"):
+        data_interface.ensure_schema()
+        check_pin_counts()
+    elif env.get_arg("fast_import"):
+        data_interface.ensure_schema()
+        fast_import()
+    else:
+        data_interface.ensure_schema()
+        scheduler.add_job(log_inserted_counts, trigger='interval', minutes=1)
+        scheduler.start()
+        main()
+        scheduler.shutdown()
+    data_interface.close_connections()
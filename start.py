@@ -6,8 +6,12 @@ from slack_bolt.oauth import OAuthFlow
 from slack_bolt.adapter.flask import SlackRequestHandler
 
 # Internal
+from STTBot import command_executor
+from STTBot import data_interface
+from STTBot import event_dedupe
+from STTBot import slack_directory
 from STTBot.events import app_mention
-from STTBot.message_loader import schedule_refresh
+from STTBot import message_loader
 from STTBot.utils import env
 
 
@@ -23,7 +27,11 @@ def start():
     server_host = env.get_cfg("SERVER_HOST")
     server_port = env.get_cfg("SERVER_PORT")
     set_bot_token()
-    scheduler = schedule_refresh(bolt_app.client)
+    data_interface.ensure_schema()
+    scheduler = message_loader.schedule_refresh(bolt_app.client)
+    scheduler.add_job(func=data_interface.analyze_database, trigger='interval',
+                      hours=env.get_cfg("DB_ANALYZE_HOURS") or 24, max_instances=1, coalesce=True,
+                      id='analyze_database')
     http_server = WSGIServer((server_host, server_port), flask_app, log=env.log)
 
     try:
@@ -33,6 +41,9 @@ def start():
         env.log.info("Shutting down")
         http_server.close()
         scheduler.shutdown()
+        command_executor.executor.shutdown()
+        message_loader.live_writer.stop()
+        data_interface.close_connections()
         env.log.info("Shut down")
 
 
@@ -44,6 +55,11 @@ def set_bot_token():
         bolt_app.client.token = installation.bot_token
 
 
+def get_header(request, name):
+    values = request.headers.get(name) or []
+    return values[0] if len(values) > 0 else None
+
+
 # - Slack routes - #
 
 @flask_app.route("/slack/install", methods=["GET"])
@@ -64,15 +80,32 @@ def route_slack_events():
 # - Slack handlers - #
 
 @bolt_app.event("app_mention")
-def handle_app_mention(client, body, say):
-    app_mention.handle(client, body, say)
+def handle_app_mention(client, body, say, request):
+    app_mention.handle(client, body, say, retry_num=get_header(request, "x-slack-retry-num"),
+                       retry_reason=get_header(request, "x-slack-retry-reason"))
+
+
+@bolt_app.event("message")
+def handle_message(client, event):
+    message_loader.handle_message_event(client, event)
+
+
+def handle_channel_change(body):
+    slack_directory.channels.invalidate()
+
+
+for channel_event in ["channel_created", "channel_deleted", "channel_rename", "group_rename"]:
+    bolt_app.event(channel_event)(handle_channel_change)
 
 
 # - Custom routes - #
 
 @flask_app.route("/status", methods=["GET"])
 def route_status():
-    return {"status": 200, "message": "All good!"}
+    return {"status": 200, "message": "All good!", "db_pool": data_interface.get_pool_stats(),
+            "db_writer": data_interface.get_writer_stats(), "regex_workers": data_interface.get_regex_worker_stats(),
+            "result_cache": data_interface.get_result_cache_stats(),
+            "commands": command_executor.executor.stats(), "events": event_dedupe.seen_events.stats()}
 
 
 if __name__ == "__main__":
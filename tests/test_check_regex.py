@@ -0,0 +1,50 @@
+"""
+Checks which search patterns `data_interface.check_regex` turns away before they reach a regex worker.
+
+    python3.7 -m unittest tests.test_check_regex
+"""
+
+# External
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+# Internal
+# data_interface reads its config from the command line when imported.
+config_dir = tempfile.mkdtemp(prefix="sttbot-test-")
+config_path = os.path.join(config_dir, "config.json")
+with open(config_path, "w") as f:
+    json.dump({"PATH_DB": os.path.join(config_dir, "test.db")}, f)
+argv, sys.argv = sys.argv, [sys.argv[0], "--env", config_path]
+try:
+    from STTBot import data_interface
+finally:
+    sys.argv = argv
+
+
+class CheckRegexTest(unittest.TestCase):
+
+    def test_unambiguous_patterns_are_allowed(self):
+        for search in [r"lol", r"\blol\b", r"(\w)\1", r"(\w+)\s+\1", r"(\w+ )+", r"(lo+)+l", r"(a|ab)*c", r"(a+b)+$",
+                       r"(?:[a-z]+\.)+com", r".*.*x$", r"(a+)++"]:
+            for ignore_case in (True, False):
+                with self.subTest(search=search, ignore_case=ignore_case):
+                    data_interface.check_regex(data_interface.regex_for(search, ignore_case))
+
+    def test_ambiguous_repeats_are_rejected(self):
+        for search in [r"(a+)+$", r"(a*)*", r"(\w+\s?)+$", r"(x+x+)+y", r"(\d+,?)+$", r"(\w+a)+", r"(.*)*",
+                       r"(.|\s)*x", r"(k+K)+"]:
+            with self.subTest(search=search):
+                with self.assertRaises(data_interface.QueryBudgetExceeded):
+                    data_interface.check_regex(data_interface.regex_for(search, True))
+
+    def test_case_sensitivity_is_respected(self):
+        data_interface.check_regex(data_interface.regex_for(r"(k+K)+", False))
+        with self.assertRaises(data_interface.QueryBudgetExceeded):
+            data_interface.check_regex(data_interface.regex_for(r"(?i:k+K)+", False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Runs `message_loader.crawl_channels` against a stub Slack client.
+
+    python3.7 -m unittest tests.test_crawl_channels
+
+The stub serves `conversations_history` in pages, can answer a channel's first request with a 429, and can fail a
+channel partway through, so paging, retries and high-water marks are checked without talking to Slack.
+"""
+
+# External
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from slack_sdk.errors import SlackApiError
+
+# Internal
+# data_interface reads its config from the command line when imported.
+config_dir = tempfile.mkdtemp(prefix="sttbot-test-")
+config_path = os.path.join(config_dir, "config.json")
+settings = {"PERMALINK_BASE_URL": "https://example.slack.com/archives", "CRAWL_WORKERS": 2, "SLACK_TIER3_RATE": 6000}
+with open(config_path, "w") as f:
+    json.dump({"PATH_DB": os.path.join(config_dir, "test.db"), **settings}, f)
+argv, sys.argv = sys.argv, [sys.argv[0], "--env", config_path]
+try:
+    from STTBot import data_interface, message_loader
+    from STTBot.utils import env, rate_limit
+finally:
+    sys.argv = argv
+
+# Another test module may have loaded its own config first.
+env.cfg.update(settings)
+rate_limit.tier_3.set_rate(settings["SLACK_TIER3_RATE"])
+
+
+class StubResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class StubClient:
+    """Serves each channel's messages `page_size` at a time, newest first, the way `conversations.history` does."""
+
+    def __init__(self, messages, page_size=2, rate_limited=(), failing=()):
+        self.messages = messages
+        self.page_size = page_size
+        self.rate_limited = set(rate_limited)
+        self.failing = set(failing)
+        self.calls = []
+
+    def conversations_history(self, channel, cursor=None, oldest=None, latest=None, inclusive=True):
+        self.calls.append((channel, cursor))
+        if channel in self.rate_limited:
+            self.rate_limited.remove(channel)
+            raise SlackApiError("ratelimited", StubResponse(429, {"Retry-After": "0.01"}))
+        if channel in self.failing and cursor is not None:
+            raise SlackApiError("internal_error", StubResponse(500))
+
+        messages = sorted((message for message in self.messages[channel] if float(message["ts"]) > float(oldest)),
+                          key=lambda message: float(message["ts"]), reverse=True)
+        start = int(cursor or 0)
+        page = messages[start:start + self.page_size]
+        has_more = start + self.page_size < len(messages)
+        return {"messages": page, "has_more": has_more,
+                "response_metadata": {"next_cursor": str(start + self.page_size) if has_more else ""}}
+
+
+def make_messages(count, first_ts=1600000000):
+    return [{"ts": f"{first_ts + i}.000100", "user": "U1", "text": f"message {i}"} for i in range(count)]
+
+
+class CrawlChannelsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        data_interface.ensure_schema()
+
+    @classmethod
+    def tearDownClass(cls):
+        data_interface.close_connections()
+
+    def setUp(self):
+        self.sync_writes = []
+        self.stored_at_sync = {}
+
+    def crawl(self, client, channels):
+        def set_sync_state(channel_id, high_water_mark):
+            keys = [(channel_id, message["ts"]) for message in client.messages[channel_id]]
+            self.stored_at_sync[channel_id] = len(data_interface.get_messages(keys))
+            future = original_set_sync_state(channel_id, high_water_mark)
+            self.sync_writes.append(future)
+            return future
+
+        original_set_sync_state = data_interface.set_sync_state
+        with mock.patch.object(data_interface, "set_sync_state", side_effect=set_sync_state):
+            message_loader.crawl_channels(client, channels, {"U1": "alice"}, {channel: "0" for channel in channels})
+        for future in self.sync_writes:
+            future.result()
+
+    def test_pages_are_followed_until_has_more_is_false(self):
+        client = StubClient({"C1": make_messages(5)})
+        self.crawl(client, {"C1": "general"})
+
+        self.assertEqual(client.calls, [("C1", None), ("C1", "2"), ("C1", "4")])
+        stored = data_interface.get_messages([("C1", message["ts"]) for message in client.messages["C1"]])
+        self.assertEqual(len(stored), 5)
+        self.assertEqual({row["user_name"] for row in stored.values()}, {"alice"})
+
+    def test_rate_limited_request_is_retried_after_retry_after(self):
+        client = StubClient({"C2": make_messages(3)}, rate_limited=["C2"])
+        with mock.patch.object(rate_limit.tier_3, "pause", wraps=rate_limit.tier_3.pause) as pause:
+            self.crawl(client, {"C2": "random"})
+
+        pause.assert_called_once_with(0.01)
+        self.assertEqual(client.calls, [("C2", None), ("C2", None), ("C2", "2")])
+        self.assertEqual(data_interface.get_sync_state()["C2"], "1600000002.000100")
+
+    def test_high_water_mark_is_recorded_after_the_channels_rows(self):
+        client = StubClient({"C3": make_messages(4, first_ts=1600001000), "C4": make_messages(4, first_ts=1600002000)},
+                            failing=["C4"])
+        self.crawl(client, {"C3": "dev", "C4": "ops"})
+
+        self.assertEqual(self.stored_at_sync, {"C3": 4})
+        sync_state = data_interface.get_sync_state()
+        self.assertEqual(sync_state["C3"], "1600001003.000100")
+        self.assertNotIn("C4", sync_state)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Randomised equivalence checks for the REGEXP prefilters built by `data_interface.plan_regex_filters`.
+
+    python3.7 -m unittest tests.test_regex_planner
+
+Each generated pattern is run over a generated messages table twice, once with its prefilters in front of REGEXP and
+once as a plain `re.search` scan, and the per-user counts must match.
+"""
+
+# External
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+# Internal
+# data_interface reads its config from the command line when imported.
+config_dir = tempfile.mkdtemp(prefix="sttbot-test-")
+config_path = os.path.join(config_dir, "config.json")
+with open(config_path, "w") as f:
+    json.dump({"PATH_DB": os.path.join(config_dir, "test.db")}, f)
+argv, sys.argv = sys.argv, [sys.argv[0], "--env", config_path]
+try:
+    from STTBot import data_interface
+finally:
+    sys.argv = argv
+
+
+# Letters whose case-insensitive matches include non-ASCII characters, LIKE wildcards and escapes are over-represented.
+alphabet = "abkKsSiIlo _%\\.Kſéİ"
+atoms = ["a", "b", "k", "s", "i", "l", "o", "lo", "ab", "%", "_", "\\.", ".", "\\w", "[ab]", "(?:ab|lo)", "(lo)",
+         "(?i:ks)", "(?-i:ab)", "é"]
+quantifiers = ["", "", "*", "+", "?", "{2}", "{1,3}", "*?"]
+
+
+class RegexPlannerTest(unittest.TestCase):
+    pattern_count = 1000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.random = random.Random(0)
+        cls.con = sqlite3.connect(":memory:")
+        data_interface.register_functions(cls.con)
+        cls.con.execute("CREATE TABLE messages (user_name text, message text)")
+        messages = ["".join(cls.random.choice(alphabet) for _ in range(cls.random.randint(0, 12)))
+                    for _ in range(3000)]
+        cls.con.executemany("INSERT INTO messages VALUES (?, ?)",
+                            [(cls.random.choice("xyz"), message) for message in messages + [None]])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.con.close()
+
+    def test_prefiltered_scan_matches_full_scan(self):
+        checked = 0
+        for _ in range(self.pattern_count):
+            pattern = "".join(self.random.choice(atoms) + self.random.choice(quantifiers)
+                              for _ in range(self.random.randint(1, 4)))
+            for ignore_case in (True, False):
+                try:
+                    expected = self._scan(pattern, ignore_case)
+                except re.error:
+                    continue
+                expr = data_interface.regex_for(pattern, ignore_case)
+                filters, params = data_interface.plan_regex_filters(expr)
+                rows = self.con.execute(f"SELECT user_name, count(*) FROM messages WHERE {filters}message REGEXP ? "
+                                        f"GROUP BY user_name ORDER BY user_name", params + [expr]).fetchall()
+                self.assertEqual(rows, expected, f"{pattern!r} (ignore_case={ignore_case}) with {filters!r} {params}")
+                checked += 1
+        self.assertGreater(checked, self.pattern_count)
+
+    def test_required_literals_become_filters(self):
+        filters, params = data_interface.plan_regex_filters("ab(cd)+ef?")
+        self.assertEqual(sorted(params), ["ab", "cd", "e"])
+        self.assertEqual(filters.count("instr"), 3)
+        self.assertEqual(data_interface.plan_regex_filters("a*|b"), ("", []))
+
+    def _scan(self, pattern, ignore_case):
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        counts = {}
+        for user_name, message in self.con.execute("SELECT user_name, message FROM messages"):
+            if message is not None and regex.search(message):
+                counts[user_name] = counts.get(user_name, 0) + 1
+        return sorted(counts.items())
+
+
+if __name__ == "__main__":
+    unittest.main()